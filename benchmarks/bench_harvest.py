@@ -0,0 +1,158 @@
+"""
+End-to-end benchmark against the local stand-in OAI-PMH server (oai_server.py).
+
+  harvest   Records (or AsyncRecords with --engine async) over the server:
+            records/sec and pages/sec
+  download  Downloader fetching --downloads files from the fake PDF host: MB/s
+  resync    Downloader revalidating the downloaded files with --resync: seconds
+            and MB transferred (nothing has changed)
+  main      oai-harvest main() with a search pattern, metadata and filelist
+            output (and --download with --main-download): seconds
+
+The server runs in its own process with a fresh corpus for each size, each
+benchmark runs in its own process so that peak RSS is comparable.
+
+  python benchmarks/bench_harvest.py --sizes 1000 10000 50000
+  python benchmarks/bench_harvest.py --latency 0.05 --engine async --workers 50
+  python benchmarks/bench_harvest.py --error-rate 0.05 --downloads 500
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+BENCHMARKS = ["harvest", "download", "resync", "main"]
+SERVER = str(Path(__file__).resolve().parent / "oai_server.py")
+
+
+def stats(url):
+    with urllib.request.urlopen(url.replace("/oai", "/stats")) as response:
+        return json.load(response)
+
+
+def bench_harvest(args):
+    from webscraper.oai_harvester import AsyncRecords, Records
+    engine = AsyncRecords if args.engine == "async" else Records
+    before = stats(args.url)
+    start = time.perf_counter()
+    records = engine(args.url, None, workers=args.workers, shard=args.shard)
+    count = sum(1 for record in records if record.metadata)
+    elapsed = time.perf_counter() - start
+    pages = stats(args.url).get("ListRecords", 0) - before.get("ListRecords", 0)
+    return {"records": count, "seconds": elapsed, "records_per_sec": count / elapsed, "pages_per_sec": pages / elapsed}
+
+
+def bench_download(args):
+    from webscraper.oai_harvester import Downloader
+    host = args.url.replace("/oai", "")
+    with tempfile.TemporaryDirectory() as outdir:
+        downloader = Downloader(outdir, concurrency=args.concurrency)
+        for i in range(args.downloads):
+            downloader.url = "%s/bitstream/handle/10024/%s/doc%s_0.pdf" % (host, i, i)
+        start = time.perf_counter()
+        downloader.threaded_download()
+        elapsed = time.perf_counter() - start
+        size = sum(path.stat().st_size for path in Path(outdir).iterdir() if path.is_file())
+    return {"files": downloader._download_success, "seconds": elapsed, "mb_per_sec": size / 1024**2 / elapsed}
+
+
+def bench_resync(args):
+    from webscraper.oai_harvester import Downloader
+    host = args.url.replace("/oai", "")
+    urls = ["%s/bitstream/handle/10024/%s/doc%s_0.pdf" % (host, i, i) for i in range(args.downloads)]
+    with tempfile.TemporaryDirectory() as outdir:
+        downloader = Downloader(outdir, concurrency=args.concurrency)
+        downloader._urls = list(urls)
+        downloader.threaded_download()
+        before = stats(args.url)
+        downloader = Downloader(outdir, concurrency=args.concurrency, resync=True)
+        downloader._urls = downloader.manifest_urls()
+        start = time.perf_counter()
+        downloader.threaded_download()
+        elapsed = time.perf_counter() - start
+    transferred = stats(args.url).get("file_bytes", 0) - before.get("file_bytes", 0)
+    return {"files": downloader._download_unchanged, "seconds": elapsed, "mb_transferred": transferred / 1024**2}
+
+
+def bench_main(args):
+    from webscraper import oai_harvester
+    with tempfile.TemporaryDirectory() as outdir:
+        sys.argv = ["oai-harvest", args.url, "-sp", args.searchpattern, "-w", str(args.workers),
+                    "-e", args.engine, "-m", os.path.join(outdir, "metadata.csv"),
+                    "-f", os.path.join(outdir, "filelist.txt")]
+        if args.shard:
+            sys.argv += ["-s", args.shard]
+        if args.main_download:
+            sys.argv += ["--download", "-o", os.path.join(outdir, "docs"), "-cc", str(args.concurrency)]
+        start = time.perf_counter()
+        oai_harvester.main()
+        elapsed = time.perf_counter() - start
+        with open(os.path.join(outdir, "metadata.csv"), encoding="utf-8") as f:
+            matches = sum(1 for _ in f) - 1
+    return {"matches": matches, "seconds": elapsed}
+
+
+# Child process: run one benchmark and report as JSON
+def measure(benchmark, args):
+    result = {"harvest": bench_harvest, "download": bench_download, "resync": bench_resync,
+              "main": bench_main}[benchmark](args)
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(result))
+
+
+def start_server(size, args):
+    command = [sys.executable, SERVER, "--port", "0", "--records", str(size), "--latency", str(args.latency),
+               "--error-rate", str(args.error_rate), "--pdf-size", str(args.pdf_size)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    return server, server.stdout.readline().strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="corpus sizes")
+    parser.add_argument("--benchmarks", choices=BENCHMARKS, nargs="+", default=BENCHMARKS)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of file requests failing with 503")
+    parser.add_argument("--pdf-size", type=int, default=256, help="size of served files in kB")
+    parser.add_argument("--engine", choices=["sickle", "async"], default="sickle")
+    parser.add_argument("--workers", type=int, default=1, help="oai-harvest --workers")
+    parser.add_argument("--shard", choices=["year", "month", "auto"], help="oai-harvest --shard")
+    parser.add_argument("--downloads", type=int, default=200, help="number of files in download benchmark")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent downloads")
+    parser.add_argument("--searchpattern", type=str, default="[Mm]aaseu.*", help="pattern of main benchmark")
+    parser.add_argument("--main-download", action="store_true", help="download matching files in main benchmark")
+    parser.add_argument("--benchmark", choices=BENCHMARKS, help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        return measure(args.benchmark, args)
+
+    print(f"{'size':>8}  {'benchmark':<10}{'seconds':>10}{'records/s':>12}{'pages/s':>10}{'MB/s':>10}"
+          f"{'MB moved':>10}{'peak RSS MB':>14}")
+    for size in args.sizes:
+        server, url = start_server(size, args)
+        try:
+            for benchmark in args.benchmarks:
+                output = subprocess.run([sys.executable, __file__, "--benchmark", benchmark, "--url", url,
+                                         *sys.argv[1:]], check=True, capture_output=True, text=True).stdout
+                result = json.loads(output.splitlines()[-1])
+                print(f"{size:>8}  {benchmark:<10}{result['seconds']:>10.2f}{result.get('records_per_sec', 0):>12.0f}"
+                      f"{result.get('pages_per_sec', 0):>10.1f}{result.get('mb_per_sec', 0):>10.1f}"
+                      f"{result.get('mb_transferred', 0):>10.1f}{result['peak_rss_mb']:>14.1f}", flush=True)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
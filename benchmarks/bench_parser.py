@@ -0,0 +1,148 @@
+"""
+Benchmark of record parsing and filtering: records/sec and peak RSS.
+
+  legacy  Sickle's item iterator and Record._parse_metadata before the single
+          pass parser: each page parsed three times (error, resumption token,
+          records), sickle.models.Record built for every record and the kk
+          fields searched with two findall() walks.
+  record  Current Records/Record path: page parsed once, RecordFilter checks
+          language and patterns first and only records that pass are parsed
+          fully, in one pass.
+
+With --language and --searchpattern both implementations filter the records
+the same way as oai-harvest -l / -sp.
+
+Each implementation runs in its own process so that peak RSS is comparable.
+
+  python benchmarks/bench_parser.py --records 20000
+  python benchmarks/bench_parser.py --corpus oai-cache
+  python benchmarks/bench_parser.py --language sv --searchpattern "[Kk]aupun.*"
+"""
+
+import argparse
+import json
+import re
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from corpus import load_corpus, synthetic_corpus
+
+IMPLEMENTATIONS = ["legacy", "record"]
+OAI = "{http://www.openarchives.org/OAI/2.0/}"
+
+
+def legacy_parse(xml):
+    meta = {}
+    key_words = []
+    urls = []
+    for field in xml.findall(".//{http://kk/1.0}field"):
+        elem = field.get("element")
+        qualif = field.get("qualifier")
+        value = field.get("value")
+        match (elem, qualif):
+            case ("title", None):
+                meta["title"] = value
+            case ("description", "abstract"):
+                meta["abstract"] = value
+            case ("relation", "ispartofseries"):
+                meta["publication"] = value
+            case ("publisher", None):
+                meta["publisher"] = value
+            case ("subject", None):
+                key_words.append(value)
+            case ("language", "iso"):
+                meta["language"] = value
+            case ("date", "issued"):
+                meta["published"] = value
+    for file in xml.findall(".//{http://kk/1.0}file"):
+        if file.get("type") == "application/pdf":
+            urls.append(file.get("href"))
+    return {**meta, "key_words": key_words, "urls": urls}
+
+
+def legacy_filter(metadata, language, pattern):
+    if language and metadata.get("language") != language:
+        return False
+    if not pattern:
+        return True
+    entries = [i for i in [metadata.get("title"), metadata.get("abstract"), *metadata.get("key_words")]
+               if i is not None]
+    return any([re.search(pattern, entry) for entry in entries])
+
+
+def run_legacy(pages, language, pattern):
+    from lxml import etree
+    from sickle.models import Record as SickleRecord
+    from sickle.response import XMLParser
+    records = []
+    for content in pages:
+        etree.XML(content, parser=XMLParser).find(".//" + OAI + "error")
+        etree.XML(content, parser=XMLParser).find(".//" + OAI + "resumptionToken")
+        for element in etree.XML(content, parser=XMLParser).iterfind(".//" + OAI + "record"):
+            record = SickleRecord(element)
+            metadata = legacy_parse(record.xml)
+            if legacy_filter(metadata, language, pattern):
+                records.append((record, metadata))
+    return len(records)
+
+
+def run_record(pages, language, pattern):
+    from lxml import etree
+    from sickle.response import XMLParser
+    from webscraper.oai_harvester import OAI_LISTRECORDS, OAI_RECORD, Record, RecordFilter
+    record_filter = RecordFilter(language, pattern)
+    records = []
+    for content in pages:
+        xml = etree.XML(content, parser=XMLParser)
+        for element in xml.iterfind(OAI_LISTRECORDS + "/" + OAI_RECORD):
+            record = Record(element)
+            if record_filter(record):
+                record.metadata
+                records.append(record)
+    return len(records)
+
+
+# Child process: parse the corpus and report as JSON
+def measure(implementation, args):
+    pages = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.records)
+    start = time.perf_counter()
+    count = {"legacy": run_legacy, "record": run_record}[implementation](pages, args.language, args.searchpattern)
+    elapsed = time.perf_counter() - start
+    records = sum(page.count(b"<record>") for page in pages)
+    print(json.dumps({"implementation": implementation,
+                      "records": records,
+                      "matches": count,
+                      "seconds": elapsed,
+                      "records_per_sec": records / elapsed,
+                      "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=10000, help="size of synthetic corpus")
+    parser.add_argument("--corpus", type=str, help="directory of recorded pages (eg. response cache)")
+    parser.add_argument("--language", type=str, help="filter by language")
+    parser.add_argument("--searchpattern", type=str, help="filter by regex")
+    parser.add_argument("--implementation", choices=IMPLEMENTATIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.implementation:
+        return measure(args.implementation, args)
+
+    print(f"{'implementation':<16}{'records':>10}{'matches':>10}{'records/s':>12}{'peak RSS MB':>14}")
+    for implementation in IMPLEMENTATIONS:
+        output = subprocess.run([sys.executable, __file__, "--implementation", implementation, *sys.argv[1:]],
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output)
+        print(f"{implementation:<16}{result['records']:>10}{result['matches']:>10}{result['records_per_sec']:>12.0f}"
+              f"{result['peak_rss_mb']:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Synthetic and recorded kk-format ListRecords pages for benchmarks.
+
+Recorded pages can be taken from a response cache (oai-harvest -c <directory>),
+they are read from <directory>/objects/**/*.xml.gz or plain *.xml files.
+"""
+
+import gzip
+import random
+from pathlib import Path
+from xml.sax.saxutils import quoteattr
+
+WORDS = ["maaseutu", "kaupunki", "kylä", "talous", "ympäristö", "liikenne", "lähiö", "taajama",
+         "aluekehitys", "hallinto", "koulutus", "terveys", "ilmasto", "energia", "asuminen"]
+SETS = ['com_10024_59349', 'com_10024_59351', 'com_10024_59353', 'com_10024_59355']
+PAGE_SIZE = 100
+
+
+def _text(rnd, words):
+    return " ".join(rnd.choice(WORDS) for _ in range(words))
+
+
+# Single <record> as served by julkaisut.valtioneuvosto.fi
+def make_record(i, host="https://julkaisut.valtioneuvosto.fi"):
+    rnd = random.Random(i)
+    year = 2000 + i % 24
+    fields = [("title", None, _text(rnd, 6).capitalize()),
+              ("description", "abstract", _text(rnd, 120)),
+              ("relation", "ispartofseries", "Valtioneuvoston julkaisuja %s:%s" % (year, i % 50)),
+              ("publisher", None, "Valtioneuvosto"),
+              ("language", "iso", rnd.choice(["fi", "fi", "fi", "sv", "en"])),
+              ("date", "issued", str(year)),
+              ("contributor", "author", _text(rnd, 2)),
+              ("identifier", "uri", "http://urn.fi/URN:ISBN:%s" % i),
+              ("type", None, "Julkaisu")]
+    fields += [("subject", None, rnd.choice(WORDS)) for _ in range(rnd.randint(2, 8))]
+    files = [("application/pdf", "%s/bitstream/handle/10024/%s/doc%s_%s.pdf" % (host, i, i, n))
+             for n in range(rnd.choice([1, 1, 1, 2]))]
+    files.append(("text/plain", "%s/bitstream/handle/10024/%s/license.txt" % (host, i)))
+    return ('<record><header><identifier>oai:julkaisut.valtioneuvosto.fi:10024/%s</identifier>'
+            '<datestamp>%s-%02d-%02dT08:00:00Z</datestamp><setSpec>%s</setSpec></header>'
+            '<metadata><kk:metadata xmlns:kk="http://kk/1.0" schemaLocation="http://kk/1.0 kk.xsd">'
+            % (i, year, 1 + i % 12, 1 + i % 28, SETS[i % len(SETS)])
+            + "".join('<kk:field schema="dc" element="%s"%s value=%s/>'
+                      % (element, ' qualifier="%s"' % qualifier if qualifier else "", quoteattr(value))
+                      for element, qualifier, value in fields)
+            + '<kk:files>'
+            + "".join('<kk:file type="%s" href="%s"/>' % (type, href) for type, href in files)
+            + '</kk:files></kk:metadata></metadata></record>')
+
+
+def make_page(start, count, total=None, token=None, host="https://julkaisut.valtioneuvosto.fi"):
+    records = "".join(make_record(i, host) for i in range(start, start + count))
+    resumption_token = ""
+    if total is not None:
+        resumption_token = '<resumptionToken completeListSize="%s" cursor="%s">%s</resumptionToken>' % (
+            total, start, token or "")
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+            '<responseDate>2024-10-15T12:00:00Z</responseDate>'
+            '<request verb="ListRecords" metadataPrefix="kk">https://julkaisut.valtioneuvosto.fi/oai/request</request>'
+            '<ListRecords>%s%s</ListRecords></OAI-PMH>' % (records, resumption_token)).encode("utf-8")
+
+
+def synthetic_corpus(records):
+    pages = []
+    for start in range(0, records, PAGE_SIZE):
+        count = min(PAGE_SIZE, records - start)
+        token = str(start + count) if start + count < records else None
+        pages.append(make_page(start, count, records, token))
+    return pages
+
+
+def load_corpus(directory):
+    pages = []
+    for path in sorted(Path(directory).rglob("*.xml*")):
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rb") as f:
+            content = f.read()
+        if b"ListRecords>" in content:
+            pages.append(content)
+    return pages
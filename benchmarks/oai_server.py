@@ -0,0 +1,231 @@
+"""
+Local stand-in for an OAI-PMH service with kk metadata and a PDF host.
+
+Serves Identify, ListSets and ListRecords (set, from/until and resumption
+tokens) of a synthetic corpus, or replays recorded ListRecords pages in order.
+Files linked from the records are served from /bitstream with ETag and Range
+support, conditional requests are answered with 304. Latency and errors can
+be added to every response, request counts are available as JSON from /stats.
+
+  python benchmarks/oai_server.py --records 50000 --latency 0.05
+  oai-harvest http://127.0.0.1:8000/oai -sp "[Mm]aa[-]?seu.*" -m metadata.csv
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlparse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from corpus import PAGE_SIZE, SETS, load_corpus, make_record
+
+OAI_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>'
+              '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+              '<responseDate>2024-10-15T12:00:00Z</responseDate><request>%s</request>')
+EARLIEST = "2000-01-01T00:00:00Z"
+
+
+# Datestamp and set of synthetic record i, as in corpus.make_record
+def datestamp(i):
+    return "%s-%02d-%02d" % (2000 + i % 24, 1 + i % 12, 1 + i % 28)
+
+
+def record_set(i):
+    return SETS[i % len(SETS)]
+
+
+class Corpus():
+    # Synthetic records 0..records-1, pages are built when requested
+    def __init__(self, records, host, page_size=PAGE_SIZE):
+        self.records = records
+        self.host = host
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self.page = lru_cache(maxsize=256)(self._page)
+
+    @lru_cache(maxsize=64)
+    def _selection(self, set_spec, start, until):
+        return [i for i in range(self.records)
+                if (not set_spec or record_set(i) == set_spec)
+                and (not start or datestamp(i) >= start[:10])
+                and (not until or datestamp(i) <= until[:10])]
+
+    # ListRecords page: records and resumption token, None if nothing matches
+    def _page(self, set_spec, start, until, cursor):
+        with self._lock:
+            selection = self._selection(set_spec, start, until)
+        if not selection:
+            return None
+        page = selection[cursor:cursor + self.page_size]
+        token = ""
+        if len(selection) > self.page_size:
+            next_cursor = cursor + len(page)
+            value = "|".join([str(next_cursor), set_spec, start, until]) if next_cursor < len(selection) else ""
+            token = '<resumptionToken completeListSize="%s" cursor="%s">%s</resumptionToken>' % (
+                len(selection), cursor, value)
+        return "".join(make_record(i, self.host) for i in page) + token
+
+    def list_records(self, params):
+        if "resumptionToken" in params:
+            try:
+                cursor, set_spec, start, until = params["resumptionToken"].split("|")
+                cursor = int(cursor)
+            except ValueError:
+                return '<error code="badResumptionToken">Invalid token</error>'
+        else:
+            cursor, set_spec, start, until = 0, params.get("set", ""), params.get("from", ""), params.get("until", "")
+        page = self.page(set_spec, start, until, cursor)
+        if page is None:
+            return '<error code="noRecordsMatch">No matching records</error>'
+        return "<ListRecords>%s</ListRecords>" % page
+
+
+class RecordedCorpus():
+    # Recorded ListRecords pages served in order whatever the query,
+    # resumption tokens are replaced with page numbers
+    def __init__(self, directory):
+        self.pages = []
+        for content in load_corpus(directory):
+            body = re.search(rb"<ListRecords>(.*)</ListRecords>", content, re.S).group(1).decode("utf-8")
+            self.pages.append(re.sub(r"(<resumptionToken[^>]*>)[^<]*(</resumptionToken>)|<resumptionToken[^>]*/>",
+                                     "", body))
+        self.records = sum(page.count("<record>") for page in self.pages)
+
+    def list_records(self, params):
+        index = int(params.get("resumptionToken", 0))
+        if index >= len(self.pages):
+            return '<error code="badResumptionToken">Invalid token</error>'
+        token = ""
+        if index + 1 < len(self.pages):
+            token = '<resumptionToken completeListSize="%s">%s</resumptionToken>' % (self.records, index + 1)
+        return "<ListRecords>%s%s</ListRecords>" % (self.pages[index], token)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            with server.lock:
+                return self.send(200, json.dumps(server.stats).encode("utf-8"), "application/json")
+        is_file = url.path.startswith("/bitstream")
+        if server.latency:
+            time.sleep(server.latency)
+        if server.random.random() < (server.error_rate if is_file else server.oai_error_rate):
+            server.count("errors")
+            return self.send(503, b"Service unavailable", "text/plain", {"Retry-After": "0"})
+        if is_file:
+            return self.send_file(url.path)
+        params = dict(parse_qsl(url.query))
+        verb = params.get("verb")
+        server.count(verb or "badVerb")
+        if verb == "Identify":
+            body = ("<Identify><repositoryName>Stand-in</repositoryName><protocolVersion>2.0</protocolVersion>"
+                    "<earliestDatestamp>%s</earliestDatestamp><granularity>YYYY-MM-DDThh:mm:ssZ</granularity>"
+                    "</Identify>" % EARLIEST)
+        elif verb == "ListSets":
+            body = "<ListSets>%s</ListSets>" % "".join(
+                "<set><setSpec>%s</setSpec><setName>Set %s</setName></set>" % (spec, n)
+                for n, spec in enumerate(SETS))
+        elif verb == "ListRecords":
+            body = server.corpus.list_records(params)
+        else:
+            body = '<error code="badVerb">Illegal verb</error>'
+        content = (OAI_HEADER % verb + body + "</OAI-PMH>").encode("utf-8")
+        server.count("bytes", len(content))
+        self.send(200, content, "text/xml; charset=utf-8")
+
+    # Same content for the same path, Range requests are answered with 206
+    def send_file(self, path):
+        server = self.server
+        seed = int(hashlib.sha1(path.encode("utf-8")).hexdigest()[:8], 16)
+        content = b"%PDF-1.4\n" + random.Random(seed).randbytes(server.pdf_size)
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()[:16]
+        headers = {"ETag": etag, "Content-Disposition": "attachment; filename=%s" % path.rsplit("/", 1)[-1]}
+        if self.headers.get("If-None-Match") == etag:
+            server.count("not_modified")
+            return self.send(304, b"", "application/pdf", headers)
+        status = 200
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range", etag) == etag and int(match.group(1)) < len(content):
+            offset = int(match.group(1))
+            headers["Content-Range"] = "bytes %s-%s/%s" % (offset, len(content) - 1, len(content))
+            content = content[offset:]
+            status = 206
+        server.count("files")
+        server.count("file_bytes", len(content))
+        self.send(status, content, "application/pdf", headers)
+
+    def send(self, status, content, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class OAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, records=10000, corpus=None, port=0, latency=0.0, error_rate=0.0, oai_error_rate=0.0,
+                 pdf_size=256 * 1024, seed=0):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.url = "http://127.0.0.1:%s/oai" % self.server_address[1]
+        self.corpus = RecordedCorpus(corpus) if corpus else Corpus(records, "http://127.0.0.1:%s" % self.server_address[1])
+        self.latency = latency
+        self.error_rate = error_rate
+        self.oai_error_rate = oai_error_rate
+        self.pdf_size = pdf_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + value
+
+    # Serve in a background thread, eg. in tests
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=10000, help="size of synthetic corpus")
+    parser.add_argument("--corpus", type=str, help="directory of recorded pages (eg. response cache)")
+    parser.add_argument("--port", type=int, default=8000, help="port, 0 for any free port")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of file requests answered with 503")
+    parser.add_argument("--oai-error-rate", type=float, default=0.0,
+                        help="share of OAI-PMH requests answered with 503 (harvest is not retried)")
+    parser.add_argument("--pdf-size", type=int, default=256, help="size of served files in kB")
+    args = parser.parse_args()
+
+    server = OAIServer(args.records, args.corpus, args.port, args.latency, args.error_rate, args.oai_error_rate,
+                       args.pdf_size * 1024)
+    print(server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
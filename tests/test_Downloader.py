@@ -1,7 +1,11 @@
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
 
-from webscraper.oai_harvester import Records, Record, Downloader
+from webscraper.oai_harvester import Records, Record, Downloader, TokenBucket
 
 
 @pytest.fixture
@@ -12,4 +16,124 @@ def records_data():
     
 #def test_Downloader_counters(records_data):
     
-    
\ No newline at end of file
+    
+
+def test_TokenBucket_rate():
+    bucket = TokenBucket(rate=50, burst=5)
+    start = time.monotonic()
+    for _ in range(15):
+        bucket.acquire()
+    # 5 at once, 10 more at 50 per second
+    assert 0.15 < time.monotonic() - start < 0.5
+    
+    
+def test_Downloader_delay(tmp_path):
+    downloader = Downloader(tmp_path)
+    for attempt in range(1, 10):
+        delay = downloader._delay(attempt)
+        expected = min(downloader.backoff_max, downloader.backoff * 2 ** (attempt - 1))
+        assert expected * 0.5 <= delay <= expected * 1.5
+        
+        
+def test_Downloader_store(tmp_path):
+    first = Downloader(tmp_path / 'a', store=tmp_path / 'store')
+    first.outdir.mkdir()
+    first._partdir.mkdir(parents=True)
+    part = first._partdir / 'x.part'
+    part.write_bytes(b'%PDF-1.4 test')
+    entry = {'url': 'https://example.org/1.pdf', 'filename': '1.pdf', 'etag': None, 'last_modified': None}
+    first._finish(part, first.outdir / '1.pdf', entry)
+    assert not part.exists()
+    assert (first.outdir / '1.pdf').read_bytes() == b'%PDF-1.4 test'
+    # Same url in another outdir is linked from the store without downloading
+    second = Downloader(tmp_path / 'b', store=tmp_path / 'store')
+    second.outdir.mkdir()
+    assert second._link_stored('https://example.org/1.pdf', second.outdir)
+    assert (second.outdir / '1.pdf').stat().st_ino == (first.outdir / '1.pdf').stat().st_ino
+    assert not second._link_stored('https://example.org/2.pdf', second.outdir)
+
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+        
+    def do_GET(self):
+        self.server.gate.wait()
+        content = self.server.files[self.path]
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        self.server.requests.append(self.path)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        
+        
+@pytest.fixture
+def file_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    server.files = {f'/{i}.pdf': b'%PDF-1.4 ' + bytes([i]) * 100 for i in range(3)}
+    server.requests = []
+    server.gate = threading.Event()
+    server.gate.set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    
+    
+@pytest.mark.parametrize('store', [False, True])
+def test_Downloader_resync(tmp_path, file_server, store):
+    host = 'http://127.0.0.1:%s' % file_server.server_address[1]
+    urls = [f'{host}/{i}.pdf' for i in range(3)]
+    store = tmp_path / 'store' if store else None
+    downloader = Downloader(tmp_path / 'docs', store=store)
+    downloader.outdir.mkdir()
+    for url in urls:
+        downloader.download_file(url)
+    assert downloader._download_success == 3
+    
+    # Files of the manifest are not requested again
+    file_server.requests.clear()
+    downloader = Downloader(tmp_path / 'docs', store=store)
+    for url in urls:
+        downloader.download_file(url)
+    assert file_server.requests == []
+    
+    # Only the changed file is downloaded
+    file_server.files['/1.pdf'] = b'%PDF-1.4 changed'
+    downloader = Downloader(tmp_path / 'docs', store=store, resync=True)
+    assert sorted(downloader.manifest_urls()) == urls
+    for url in urls:
+        downloader.download_file(url)
+    assert (downloader._download_success, downloader._download_unchanged) == (1, 2)
+    assert (tmp_path / 'docs' / '1.pdf').read_bytes() == b'%PDF-1.4 changed'
+    assert (tmp_path / 'docs' / '0.pdf').read_bytes() == file_server.files['/0.pdf']
+    
+    
+def test_Downloader_pipeline(tmp_path, file_server):
+    host = 'http://127.0.0.1:%s' % file_server.server_address[1]
+    downloaded = []
+    downloader = Downloader(tmp_path / 'docs', concurrency=1)
+    downloader.start(queue_size=1)
+    file_server.gate.clear()
+    downloader.submit(f'{host}/0.pdf', callback=downloaded.append)
+    downloader.submit(f'{host}/1.pdf', callback=downloaded.append)
+    # Queue is full while the worker waits for the first file
+    blocked = threading.Thread(target=downloader.submit, args=(f'{host}/2.pdf', None, downloaded.append))
+    blocked.start()
+    blocked.join(0.3)
+    assert blocked.is_alive()
+    
+    file_server.gate.set()
+    blocked.join()
+    downloader.flush()
+    assert sorted(path.name for path in downloaded) == ['0.pdf', '1.pdf', '2.pdf']
+    assert downloader._download_success == 3
+    downloader.submit(f'{host}/0.pdf')
+    downloader.join()
+    assert file_server.requests == ['/0.pdf', '/1.pdf', '/2.pdf']
@@ -0,0 +1,27 @@
+from datetime import date
+
+from webscraper.oai_harvester import HarvestState
+
+
+def test_HarvestState_checkpoint(tmp_path):
+    state = HarvestState(tmp_path / "state.json")
+    assert state.run is None
+    state.update(date(2024, 10, 15), {"endpoint||kk": ["token", 42]}, {"endpoint||kk": "2024-10-14T08:00:00Z"})
+    state.save()
+    
+    state = HarvestState(tmp_path / "state.json")
+    assert state.run == {"until": "2024-10-15", 
+                         "sources": {"endpoint||kk": ["token", 42]}, 
+                         "marks": {"endpoint||kk": "2024-10-14T08:00:00Z"}}
+    assert state.mark("endpoint||kk") is None
+    
+    
+def test_HarvestState_finish(tmp_path):
+    state = HarvestState(tmp_path / "state.json")
+    state.finish({"endpoint||kk": "2024-10-14T08:00:00Z"})
+    state.finish({"endpoint||kk": "2024-10-01T08:00:00Z"})
+    state.save()
+    
+    state = HarvestState(tmp_path / "state.json")
+    assert state.run is None
+    assert state.mark("endpoint||kk") == "2024-10-14T08:00:00Z"
@@ -0,0 +1,59 @@
+import csv
+import json
+
+import pytest
+
+from webscraper.oai_harvester import Job, Records, RecordFilter, SearchPatterns, SeenSet, read_jobfile
+
+
+def kk_page(titles):
+    records = ''.join(f'<record><header><identifier>oai:{i}</identifier><datestamp>2020-01-01</datestamp></header>'
+                      f'<metadata><kk xmlns="http://kk/1.0"><field element="title" value="{title}"/></kk></metadata>'
+                      f'</record>' for i, title in enumerate(titles))
+    return (f'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListRecords>{records}'
+            f'</ListRecords></OAI-PMH>').encode('utf-8')
+
+
+def test_read_jobfile(tmp_path):
+    jobfile = tmp_path / 'jobs.toml'
+    jobfile.write_text('workers = 4\n'
+                       '[defaults]\nlanguage = "fi"\n'
+                       '[[jobs]]\nurl = "https://julkaisut.valtioneuvosto.fi/oai/request"\nworkers = 2\n'
+                       '[[jobs]]\nname = "other"\nurl = "https://example.org/oai"\nlanguage = "sv"\n', encoding='utf-8')
+    config, jobs = read_jobfile(jobfile)
+    assert config['workers'] == 4 and config['concurrency'] == 4
+    assert [job['name'] for job in jobs] == ['julkaisut.valtioneuvosto.fi', 'other']
+    assert [job['language'] for job in jobs] == ['fi', 'sv']
+    
+    jobfile = tmp_path / 'jobs.json'
+    jobfile.write_text(json.dumps({'jobs': [{'url': 'https://example.org/oai'}, {'url': 'https://example.org/oai'}]}))
+    with pytest.raises(ValueError):
+        read_jobfile(jobfile)
+        
+        
+def test_Job_options():
+    with pytest.raises(ValueError):
+        Job.from_config({'url': 'https://example.org/oai', 'searchpattern': 'x'})
+    with pytest.raises(ValueError):
+        Job.from_config({'url': 'https://example.org/oai', 'download': True})
+    with pytest.raises(ValueError):
+        Job.from_config({'url': 'https://example.org/oai', 'extract': 'text.jsonl'})
+    with pytest.raises(ValueError):
+        Job.from_config({'url': 'https://example.org/oai', 'metadata_prefix': 'oai_dc'})
+        
+        
+def test_Job_seen(monkeypatch, tmp_path):
+    page = kk_page(['Maaseudun kehitys', 'Kaupunkien kehitys', 'Maaseutu ja kaupungit'])
+    monkeypatch.setattr(Records, '_fetch', lambda self, params: page)
+    
+    def run(pattern):
+        patterns = SearchPatterns.from_args([pattern])
+        records = Records('http://localhost/oai/request', None, seen=SeenSet(tmp_path / 'seen.bin'))
+        Job(records, RecordFilter(None, patterns), patterns, metadata=str(tmp_path / 'metadata.csv')).run()
+        with open(tmp_path / 'metadata.csv', encoding='utf-8') as f:
+            return [row['title'] for row in csv.DictReader(f, delimiter=';')]
+            
+    assert run('Maaseu') == ['Maaseudun kehitys', 'Maaseutu ja kaupungit']
+    # Records not exported by the first pattern are still searched
+    assert run('[Kk]aupun') == ['Kaupunkien kehitys']
+    assert run('[Kk]aupun') == []
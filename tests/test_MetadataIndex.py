@@ -0,0 +1,43 @@
+from webscraper.oai_harvester import MetadataIndex, Record, RecordFilter
+
+
+def make_record(identifier, title, language='fi'):
+    return Record.from_metadata(identifier, '2024-01-01', 
+                                {'title': title, 'language': language, 'abstract': 'abstract',
+                                 'key_words': ['maaseutu'], 'urls': [f'https://example.org/{identifier}.pdf']})
+                                 
+                                 
+def test_MetadataIndex_records(tmp_path):
+    index = MetadataIndex(tmp_path / 'index.db', batch_size=2)
+    index.add(make_record('oai:1', 'Maaseudun tulevaisuus'))
+    index.add(make_record('oai:2', 'Kaupunkien kehitys', 'sv'))
+    index.add(make_record('oai:1', 'Maaseudun tulevaisuus 2'))
+    index.close()
+    
+    index = MetadataIndex(tmp_path / 'index.db')
+    assert len(index) == 2
+    records = list(index.records())
+    assert [record.identifier for record in records] == ['oai:2', 'oai:1']
+    assert records[1].metadata == make_record('oai:1', 'Maaseudun tulevaisuus 2').metadata
+    assert [record.identifier for record in index.records(language='sv')] == ['oai:2']
+    if index.fts:
+        assert [record.identifier for record in index.records(match='tulevaisuus')] == ['oai:1']
+        assert [record.identifier for record in index.records(match='maaseutu')] == ['oai:2', 'oai:1']
+    record_filter = RecordFilter('fi', 'Maaseu')
+    assert [record.identifier for record in index.records() if record_filter(record)] == ['oai:1']
+    
+    
+def test_MetadataIndex_batch_duplicates(tmp_path):
+    index = MetadataIndex(tmp_path / 'index.db')
+    index.add(make_record('oai:1', 'Maaseudun tulevaisuus'))
+    index.flush()
+    index.add(make_record('oai:1', 'Kaupunkien kehitys'))
+    index.add(make_record('oai:1', 'Kylien kehitys'))
+    index.close()
+    
+    index = MetadataIndex(tmp_path / 'index.db')
+    assert [record.metadata['title'] for record in index.records()] == ['Kylien kehitys']
+    if index.fts:
+        index._db.execute("INSERT INTO records_fts (records_fts) VALUES ('integrity-check')")
+        assert [record.identifier for record in index.records(match='kylien')] == ['oai:1']
+        assert list(index.records(match='kaupunkien')) == []
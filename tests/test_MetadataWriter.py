@@ -0,0 +1,64 @@
+import csv
+from datetime import date
+
+import pytest
+
+from webscraper.oai_harvester import MetadataWriter, FilelistWriter, ParquetWriter
+
+
+def read_rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f, delimiter=";"))
+        
+        
+def test_MetadataWriter_stream(tmp_path):
+    filepath = tmp_path / "metadata.csv"
+    writer = MetadataWriter(str(filepath), stream=True, batch_size=2)
+    writer.open()
+    for i in range(5):
+        writer.metadata = {"title": f"Julkaisu {i}", "language": "fi", "key_words": ["maaseutu"]}
+    assert len(writer.metadata) == 1
+    assert not filepath.exists()
+    assert len(read_rows(writer.partpath)) == 4
+    writer.close()
+    assert not writer.partpath.exists()
+    rows = read_rows(filepath)
+    assert [row["title"] for row in rows] == [f"Julkaisu {i}" for i in range(5)]
+    assert rows[0]["key_words"] == "['maaseutu']"
+    
+    
+def test_FilelistWriter_append(tmp_path):
+    filepath = tmp_path / "filelist.txt"
+    writer = FilelistWriter(str(filepath))
+    writer.url = "https://julkaisut.valtioneuvosto.fi/bitstream/1.pdf"
+    writer.flush()
+    
+    # Interrupted run is continued
+    writer = FilelistWriter(str(filepath))
+    writer.open(append=True)
+    writer.url = "https://julkaisut.valtioneuvosto.fi/bitstream/2.pdf"
+    writer.close()
+    assert filepath.read_text().splitlines() == ["https://julkaisut.valtioneuvosto.fi/bitstream/1.pdf",
+                                                 "https://julkaisut.valtioneuvosto.fi/bitstream/2.pdf"]
+    
+    
+def test_ParquetWriter(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    
+    row = {'published': '2019', 'title': 'Maaseutu', 'key_words': ['maa', 'seutu'], 'urls': ['https://x/1.pdf']}
+    writer = ParquetWriter(str(tmp_path / 'metadata.parquet'), batch_size=2)
+    writer.open()
+    for i in range(3):
+        writer.metadata = {**row, 'published': f'2019-0{i + 1}'}
+    writer.close()
+    # Continued run appends to the completed file
+    writer = ParquetWriter(str(tmp_path / 'metadata.parquet'))
+    writer.open(append=True)
+    writer.metadata = row
+    writer.close()
+    
+    table = pq.read_table(tmp_path / 'metadata.parquet')
+    assert table.column('published').to_pylist() == [date(2019, 1, 1), date(2019, 2, 1), 
+                                                     date(2019, 3, 1), date(2019, 1, 1)]
+    assert table.column('key_words').to_pylist() == [['maa', 'seutu']] * 4
+    assert not writer.partpath.exists()
@@ -0,0 +1,35 @@
+import json
+
+from webscraper.oai_harvester import Metrics, NullMetrics
+
+
+def test_Metrics(tmp_path):
+    metrics = Metrics()
+    metrics.count('records_seen')
+    metrics.count('records_seen', 2)
+    metrics.gauge('download_queue', 5)
+    metrics.gauge('download_queue', 1)
+    metrics.observe('filter_seconds', 0.002)
+    with metrics.timer('filter_seconds'):
+        pass
+    data = metrics.to_dict()
+    assert data['counters'] == {'records_seen': 3}
+    assert data['gauges'] == {'download_queue': {'last': 1, 'max': 5}}
+    assert data['histograms']['filter_seconds']['count'] == 2
+    assert data['histograms']['filter_seconds']['buckets']['0.001'] == 1
+    assert data['histograms']['filter_seconds']['buckets']['+Inf'] == 2
+    
+    metrics.write(tmp_path / 'metrics.json')
+    assert json.loads((tmp_path / 'metrics.json').read_text())['counters'] == {'records_seen': 3}
+    metrics.write(tmp_path / 'metrics.prom')
+    prometheus = (tmp_path / 'metrics.prom').read_text()
+    assert 'oai_harvest_records_seen_total 3' in prometheus
+    assert 'oai_harvest_filter_seconds_bucket{le="+Inf"} 2' in prometheus
+    
+    
+def test_NullMetrics():
+    metrics = NullMetrics()
+    assert not metrics
+    metrics.count('records_seen')
+    with metrics.timer('filter_seconds'):
+        pass
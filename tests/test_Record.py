@@ -0,0 +1,55 @@
+from lxml import etree
+
+from webscraper.oai_harvester import Record, RecordFilter, SearchPatterns
+
+
+RECORD = """<record xmlns="http://www.openarchives.org/OAI/2.0/">
+<header><identifier>oai:julkaisut.valtioneuvosto.fi:10024/1</identifier><datestamp>2024-10-15T08:00:00Z</datestamp></header>
+<metadata><kk:metadata xmlns:kk="http://kk/1.0">
+<kk:field element="title" value="Maaseutuohjelma"/>
+<kk:field element="title" qualifier="alternative" value="Landsbygdsprogram"/>
+<kk:field element="description" qualifier="abstract" value="Tiivistelmä"/>
+<kk:field element="language" qualifier="iso" value="fi"/>
+<kk:field element="date" qualifier="issued" value="2024"/>
+<kk:field element="subject" value="maaseutu"/>
+<kk:field element="subject" value="kylät"/>
+<kk:files>
+<kk:file type="application/pdf" href="https://julkaisut.valtioneuvosto.fi/bitstream/1.pdf"/>
+<kk:file type="text/plain" href="https://julkaisut.valtioneuvosto.fi/bitstream/license.txt"/>
+</kk:files>
+</kk:metadata></metadata></record>"""
+
+
+def test_Record_metadata():
+    record = Record(etree.XML(RECORD.encode()))
+    assert record.identifier == "oai:julkaisut.valtioneuvosto.fi:10024/1"
+    assert record.datestamp == "2024-10-15T08:00:00Z"
+    assert record.metadata == {"title": "Maaseutuohjelma", 
+                               "abstract": "Tiivistelmä", 
+                               "language": "fi", 
+                               "published": "2024",
+                               "key_words": ["maaseutu", "kylät"],
+                               "urls": ["https://julkaisut.valtioneuvosto.fi/bitstream/1.pdf"]}
+    
+    
+def test_Record_filter():
+    record = Record(etree.XML(RECORD.encode()))
+    assert record.filter("fi", "[Kk]yl[iä]")
+    assert not record.filter("sv", "[Kk]yl[iä]")
+    assert not record.filter(None, "[Kk]aupun")
+    
+    
+def test_RecordFilter_early_reject():
+    record = Record(etree.XML(RECORD.encode()))
+    assert not RecordFilter("sv", "[Kk]yl[iä]")(record)
+    assert record._metadata is None
+    
+    assert RecordFilter("fi", "[Mm]aaseutu")(record)
+    assert record.metadata["urls"] == ["https://julkaisut.valtioneuvosto.fi/bitstream/1.pdf"]
+    
+    
+def test_RecordFilter_patterns():
+    record_filter = RecordFilter(None, SearchPatterns({"maaseutu": "[Mm]aaseutu", "kylä": "[Kk]yl[iä]", "kaupunki": "[Kk]aupun"}))
+    record = Record(etree.XML(RECORD.encode()))
+    assert record_filter(record)
+    assert record.matches == ["maaseutu", "kylä"]
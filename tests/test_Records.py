@@ -1,8 +1,12 @@
 
+from datetime import date, timedelta
+
 import pytest
 
 from sickle import Sickle
-from webscraper.oai_harvester import Records, Record
+from webscraper import oai_harvester
+from webscraper.oai_harvester import (Records, Record, AsyncRecords, Scheduler, HarvestState, ResponseCache,
+                                       CacheMiss, SeenSet)
 
 
 @pytest.fixture(scope="function")
@@ -50,4 +54,167 @@ def test_Records_idx(kk_metadata, records_data):
         #record = next(records)
         #record_idx = record.idx
         #records_idx = records.idx
-        #assert records_idx == record_idx
\ No newline at end of file
+        #assert records_idx == record_idx        
+        
+def test_Records_concurrent():
+    records = Records('http://localhost/oai/request', None, workers=3)
+    merged = records._concurrent([iter(range(500)), iter(range(500, 2000)), iter([])])
+    assert sorted(merged) == list(range(2000))
+    
+    
+def test_Records_concurrent_error():
+    def failing():
+        yield 1
+        raise ValueError("harvest failed")
+        
+    records = Records('http://localhost/oai/request', None, workers=2)
+    with pytest.raises(ValueError):
+        list(records._concurrent([failing(), iter(range(10))]))
+
+    
+def test_Records_windows():
+    windows = Records._windows(date(2019, 11, 15), date(2020, 2, 3), 'month')
+    assert windows == [(date(2019, 11, 15), date(2019, 11, 30)),
+                       (date(2019, 12, 1), date(2019, 12, 31)),
+                       (date(2020, 1, 1), date(2020, 1, 31)),
+                       (date(2020, 2, 1), date(2020, 2, 3))]
+    windows = Records._windows(date(2019, 11, 15), date(2021, 2, 3), 'year')
+    assert windows == [(date(2019, 11, 15), date(2019, 12, 31)),
+                       (date(2020, 1, 1), date(2020, 12, 31)),
+                       (date(2021, 1, 1), date(2021, 2, 3))]
+
+    
+def oai_page(identifiers, token=None):
+    records = ''.join(f'<record><header><identifier>{i}</identifier><datestamp>2020-01-01</datestamp></header>'
+                      f'<metadata/></record>' for i in identifiers)
+    token = f'<resumptionToken completeListSize="5">{token}</resumptionToken>' if token else ''
+    return (f'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListRecords>{records}{token}'
+            f'</ListRecords></OAI-PMH>').encode('utf-8')
+            
+    
+def test_AsyncRecords(monkeypatch):
+    pytest.importorskip('aiohttp')
+    pages = {None: oai_page(['a', 'b', 'c'], 'next'), 'next': oai_page(['d', 'e'])}
+    
+    async def fetch(self, params):
+        return pages[params.get('resumptionToken')]
+        
+    monkeypatch.setattr(AsyncRecords, '_afetch', fetch)
+    records = AsyncRecords('http://localhost/oai/request', None, workers=10)
+    assert [record.identifier for record in records] == ['a', 'b', 'c', 'd', 'e']
+    assert records.idx == 5
+    
+    
+def test_Records_parse_workers(monkeypatch):
+    pages = {None: oai_page(['a', 'b', 'c'], 'next&amp;1'), 'next&1': oai_page(['d', 'e'])}
+    
+    def fetch(self, params):
+        return pages[params.get('resumptionToken')]
+        
+    monkeypatch.setattr(Records, '_fetch', fetch)
+    assert Records._resumption_raw(pages[None]) == ('next&1', '5')
+    assert Records._resumption_raw(pages['next&1']) == (None, None)
+    records = Records('http://localhost/oai/request', None, parse_workers=2)
+    assert [record.identifier for record in records] == ['a', 'b', 'c', 'd', 'e']
+    
+    
+def test_Records_scheduler(monkeypatch):
+    pages = {None: oai_page(['1', '2'], 'p2'), 'p2': oai_page(['3', '4'], 'p3'), 'p3': oai_page(['5'])}
+    requests = []
+    
+    def fetch(self, params):
+        requests.append(self.endpoint)
+        return pages[params.get('resumptionToken')]
+        
+    monkeypatch.setattr(Records, '_fetch', fetch)
+    scheduler = Scheduler(workers=1)
+    a = Records('http://a/oai', None, scheduler=scheduler)
+    b = Records('http://b/oai', None, scheduler=scheduler)
+    scheduler.start()
+    assert [record.identifier for record in a] == ['1', '2', '3', '4', '5']
+    assert [record.identifier for record in b] == ['1', '2', '3', '4', '5']
+    scheduler.close()
+    # Harvests take turns a page at a time
+    assert requests == ['http://a/oai', 'http://a/oai', 'http://b/oai', 'http://b/oai', 'http://a/oai', 'http://b/oai']
+    
+    
+def test_Records_checkpoint_expired(monkeypatch, tmp_path):
+    pages = {None: oai_page(['a', 'b', 'c'], 'p2'), 'p2': oai_page(['d', 'e'])}
+    
+    def fetch(self, params):
+        return pages[params.get('resumptionToken')]
+        
+    monkeypatch.setattr(Records, '_fetch', fetch)
+    records = Records('http://localhost/oai/request', None, state=HarvestState(tmp_path / 'state.json'))
+    assert [next(records).identifier for _ in range(5)] == ['a', 'b', 'c', 'd', 'e']
+    records.checkpoint()
+    
+    # Checkpoint token has expired, records output before are not repeated
+    pages['p2'] = (b'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+                   b'<error code="badResumptionToken">Expired</error></OAI-PMH>')
+    pages[None] = oai_page(['a', 'b', 'c', 'd', 'e'])
+    records = Records('http://localhost/oai/request', None, state=HarvestState(tmp_path / 'state.json'))
+    assert records.resuming
+    assert [record.identifier for record in records] == ['e']
+    records.checkpoint()
+    assert not (tmp_path / 'state.json.seen').exists()
+    
+    
+def test_Records_offline_shard(monkeypatch, tmp_path):
+    identify = (b'<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><Identify>'
+                b'<earliestDatestamp>2024-01-01T00:00:00Z</earliestDatestamp></Identify></OAI-PMH>')
+    
+    def request(self, params):
+        return identify if params['verb'] == 'Identify' else oai_page([params['from']])
+        
+    monkeypatch.setattr(Records, '_session_request', request)
+    cache = ResponseCache(tmp_path)
+    records = Records('http://localhost/oai/request', None, shard='year', cache=cache, session=object())
+    harvested = [record.identifier for record in records]
+    
+    # Replayed on a later day with the windows of the recorded harvest
+    class Tomorrow(date):
+        @classmethod
+        def today(cls):
+            return date.today() + timedelta(days=1)
+            
+    monkeypatch.setattr(oai_harvester, 'date', Tomorrow)
+    records = Records('http://localhost/oai/request', None, shard='year', cache=cache, offline=True)
+    assert [record.identifier for record in records] == harvested
+    with pytest.raises(CacheMiss):
+        list(Records('http://localhost/oai/request', None, shard='month', cache=cache, offline=True))
+    
+    
+def test_Records_seen_completed(monkeypatch, tmp_path):
+    monkeypatch.setattr(Records, '_fetch', lambda self, params: oai_page(['a', 'b', 'c']))
+    records = Records('http://localhost/oai/request', None, seen=SeenSet(tmp_path / 'seen.bin'))
+    records.exported(next(records)), next(records)
+    # Output of an interrupted run without state is not continued
+    records.checkpoint()
+    assert not (tmp_path / 'seen.bin').exists()
+    assert [record.identifier for record in records] == ['c']
+    records.checkpoint()
+    # Only exported records are skipped on later runs
+    seen = SeenSet(tmp_path / 'seen.bin')
+    assert 'a' in seen and 'b' not in seen
+    
+    
+def test_Scheduler_stopped(monkeypatch):
+    pages = {None: oai_page(['1', '2'], 'p2'), 'p2': oai_page(['3', '4'], 'p3'), 'p3': oai_page(['5'])}
+    
+    def fetch(self, params):
+        if self.endpoint == 'http://fail/oai' and params.get('resumptionToken'):
+            raise ValueError("harvest failed")
+        return pages[params.get('resumptionToken')]
+        
+    monkeypatch.setattr(Records, '_fetch', fetch)
+    scheduler = Scheduler(workers=1).start()
+    failing = Records('http://fail/oai', None, scheduler=scheduler)
+    with pytest.raises(ValueError):
+        list(failing)
+    stopped = Records('http://a/oai', None, scheduler=scheduler)
+    next(stopped)
+    stopped.close()
+    assert scheduler._harvests == []
+    assert [record.identifier for record in Records('http://b/oai', None, scheduler=scheduler)] == ['1', '2', '3', '4', '5']
+    scheduler.close()
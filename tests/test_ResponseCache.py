@@ -0,0 +1,37 @@
+from webscraper.oai_harvester import ResponseCache
+
+
+ENDPOINT = 'https://julkaisut.valtioneuvosto.fi/oai/request'
+
+
+def test_ResponseCache_get(tmp_path):
+    cache = ResponseCache(tmp_path)
+    params = {'verb': 'ListRecords', 'metadataPrefix': 'kk'}
+    assert cache.get(ENDPOINT, params) is None
+    cache.put(ENDPOINT, params, b'<OAI-PMH>page</OAI-PMH>')
+    assert cache.get(ENDPOINT, {'metadataPrefix': 'kk', 'verb': 'ListRecords'}) == b'<OAI-PMH>page</OAI-PMH>'
+    assert cache.get(ENDPOINT, {**params, 'set': 'com_10024_59349'}) is None
+    
+    
+def test_ResponseCache_evict(tmp_path):
+    cache = ResponseCache(tmp_path)
+    cache.put(ENDPOINT, {'resumptionToken': '1'}, b'page 1')
+    cache.max_size = cache.size * 2
+    cache.put(ENDPOINT, {'resumptionToken': '2'}, b'page 2')
+    cache.get(ENDPOINT, {'resumptionToken': '1'})
+    cache.put(ENDPOINT, {'resumptionToken': '3'}, b'page 3')
+    assert cache.get(ENDPOINT, {'resumptionToken': '1'}) == b'page 1'
+    assert cache.get(ENDPOINT, {'resumptionToken': '2'}) is None
+    assert cache.get(ENDPOINT, {'resumptionToken': '3'}) == b'page 3'
+    
+    
+def test_ResponseCache_size(tmp_path):
+    cache = ResponseCache(tmp_path)
+    cache.put(ENDPOINT, {'resumptionToken': '1'}, b'page 1')
+    cache.put(ENDPOINT, {'resumptionToken': '2'}, b'page 1')
+    assert cache.size == ResponseCache(tmp_path).size
+    cache.put(ENDPOINT, {'resumptionToken': '2'}, b'page 2' * 100)
+    cache.put(ENDPOINT, {'resumptionToken': '1'}, b'page 2' * 100)
+    cache.close()
+    # Running total is the same as the one summed from the index
+    assert ResponseCache(tmp_path).size == cache.size
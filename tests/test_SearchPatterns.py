@@ -0,0 +1,67 @@
+import pytest
+
+from webscraper.oai_harvester import SearchPatterns, output_path
+
+
+@pytest.fixture
+def patterns():
+    return SearchPatterns.from_args(["maaseutu=[Mm]aa[-]?seu.*", "kaupunki=[Kk]aupun.*", "kylä=[Kk]yl[iä].*"])
+    
+    
+def test_SearchPatterns_parse():
+    assert SearchPatterns.parse("maaseutu=[Mm]aa[-]?seu.*") == ("maaseutu", "[Mm]aa[-]?seu.*")
+    assert SearchPatterns.parse("[Mm]aa[-]?seu.*") == (None, "[Mm]aa[-]?seu.*")
+    assert SearchPatterns.parse("(?=x)y") == (None, "(?=x)y")
+    
+    
+def test_SearchPatterns_parse_plain():
+    assert SearchPatterns.parse("(?i)foo=bar") == (None, "(?i)foo=bar")
+    assert SearchPatterns.parse("1x=y") == (None, "1x=y")
+    assert SearchPatterns.parse("a b=c") == (None, "a b=c")
+    assert SearchPatterns.parse("x=") == (None, "x=")
+    assert SearchPatterns.parse("x[=]y") == (None, "x[=]y")
+    assert SearchPatterns.parse("lähiö=[Ll]ähiö.*") == ("lähiö", "[Ll]ähiö.*")
+    
+    
+def test_SearchPatterns_match(patterns):
+    assert patterns.match(["Maaseudun kehittäminen", "Kylien tulevaisuus"]) == ["maaseutu", "kylä"]
+    assert patterns.match(["Kaupunkien ja maaseudun väliset erot"]) == ["maaseutu", "kaupunki"]
+    assert patterns.match(["Valtion talousarvio"]) == []
+    
+    
+def test_SearchPatterns_match_all():
+    assert SearchPatterns().match(["Valtion talousarvio"]) == [None]
+    
+    
+def test_SearchPatterns_patternfile(tmp_path):
+    patternfile = tmp_path / "patterns.txt"
+    patternfile.write_text("# comment\nmaaseutu=[Mm]aa[-]?seu.*\n\nkaupunki=[Kk]aupun.*\n", encoding="utf-8")
+    patterns = SearchPatterns.from_args(["lähiö=[Ll]ähiö.*"], patternfile)
+    assert patterns.names == ["maaseutu", "kaupunki", "lähiö"]
+    
+    
+def test_SearchPatterns_unnamed():
+    with pytest.raises(ValueError):
+        SearchPatterns.from_args(["[Mm]aa[-]?seu.*", "kaupunki=[Kk]aupun.*"])
+        
+        
+def test_output_path():
+    assert output_path("metadata_{name}_2024.csv", "maaseutu") == "metadata_maaseutu_2024.csv"
+    assert output_path("metadata.csv", "maaseutu") == "metadata_maaseutu.csv"
+    assert output_path("metadata.csv", None) == "metadata.csv"
+    assert output_path(None, "maaseutu") is None
+    
+    
+def test_SearchPatterns_match_stops(patterns):
+    def entries():
+        yield "Maaseudun kylät ja kaupungit"
+        raise AssertionError("all patterns matched already")
+        
+    assert patterns.match(entries()) == ["maaseutu", "kaupunki", "kylä"]
+    
+    
+def test_SearchPatterns_not_combined():
+    patterns = SearchPatterns.from_args(["a=(?i)kaupunki", "b=maaseutu"])
+    assert patterns.match(["KAUPUNKI ja maaseutu"]) == ["a", "b"]
+    patterns = SearchPatterns.from_args(["a=(?P<x>[Kk]aupun.*)", "b=(?P<x>[Mm]aaseu.*)"])
+    assert patterns.match(["Maaseudun kehittäminen"]) == ["b"]
@@ -0,0 +1,25 @@
+from webscraper.oai_harvester import SeenSet
+
+
+def test_SeenSet_add():
+    seen = SeenSet()
+    seen.merge_size = 10
+    identifiers = [f'oai:julkaisut.valtioneuvosto.fi:10024/{i}' for i in range(1000)]
+    for identifier in identifiers:
+        seen.add(identifier)
+        seen.add(identifier)
+    assert len(seen) == 1000
+    assert all(identifier in seen for identifier in identifiers)
+    assert 'oai:julkaisut.valtioneuvosto.fi:10024/1000' not in seen
+    assert list(seen._digests) == sorted(seen._digests)
+    
+    
+def test_SeenSet_save(tmp_path):
+    seen = SeenSet(tmp_path / 'seen.bin')
+    seen.add('oai:a')
+    seen.add('oai:b')
+    seen.save()
+    assert (tmp_path / 'seen.bin').stat().st_size == 16
+    
+    seen = SeenSet(tmp_path / 'seen.bin')
+    assert 'oai:a' in seen and 'oai:b' in seen and 'oai:c' not in seen
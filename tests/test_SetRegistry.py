@@ -0,0 +1,34 @@
+import pytest
+
+from webscraper.oai_harvester import KansallisarkistoOAI, SetRegistry
+
+URL = 'https://julkaisut.valtioneuvosto.fi/oai/request'
+SETS = {'col_10024_1': 'Oikeusministeriö', 'com_10024_59349': 'Oikeusministeriö', 'com_10024_59351': 'Sisäministeriö'}
+
+
+def test_SetRegistry_cache(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(SetRegistry, 'fetch', lambda self: calls.append(1) or SETS)
+    registry = SetRegistry(URL, cache_dir=tmp_path)
+    assert registry.lookup == {'Oikeusministeriö': 'com_10024_59349', 'Sisäministeriö': 'com_10024_59351'}
+    assert registry.resolve(['Sisäministeriö', 'com_10024_59349']) == ['com_10024_59351', 'com_10024_59349']
+    with pytest.raises(ValueError):
+        registry.resolve(['Ulkoministeriö'])
+
+    assert SetRegistry(URL, cache_dir=tmp_path).lookup == registry.lookup
+    assert len(calls) == 1
+    SetRegistry(URL, ttl=0, cache_dir=tmp_path).lookup
+    assert len(calls) == 2
+
+
+def test_SetRegistry_fallback(tmp_path, monkeypatch):
+    def fail(self):
+        raise ConnectionError
+    monkeypatch.setattr(SetRegistry, 'fetch', fail)
+    assert SetRegistry(URL, cache_dir=tmp_path).lookup == KansallisarkistoOAI.sets_lookup
+
+    monkeypatch.setattr(SetRegistry, 'fetch', lambda self: SETS)
+    SetRegistry(URL, cache_dir=tmp_path).lookup
+    monkeypatch.setattr(SetRegistry, 'fetch', fail)
+    assert 'Sisäministeriö' in SetRegistry(URL, ttl=0, cache_dir=tmp_path).lookup
+    assert 'Sisäministeriö' in SetRegistry(URL, ttl=0, cache_dir=tmp_path, offline=True).lookup
@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+
+import pytest
+
+from webscraper.oai_harvester import TextExtractor, _pdf_backend
+
+
+def pdf(texts):
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               '<< /Type /Pages /Kids [%s] /Count %s >>' % (' '.join(f'{4 + 2 * i} 0 R' for i in range(len(texts))),
+                                                            len(texts)),
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    for i, text in enumerate(texts):
+        stream = f'BT /F1 12 Tf 72 720 Td ({text}) Tj ET'
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {5 + 2 * i} 0 R '
+                       f'/Resources << /Font << /F1 3 0 R >> >> >>')
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+    content = b'%PDF-1.4\n'
+    offsets = []
+    for n, obj in enumerate(objects, 1):
+        offsets.append(len(content))
+        content += f'{n} 0 obj\n{obj}\nendobj\n'.encode('latin-1')
+    xref = len(content)
+    content += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    content += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode()
+    content += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    return content
+
+
+@pytest.fixture
+def backend():
+    try:
+        return _pdf_backend()
+    except ImportError:
+        pytest.skip("No pdf library installed")
+
+
+def test_TextExtractor(tmp_path, backend):
+    (tmp_path / 'a.pdf').write_bytes(pdf(['Maaseutu', 'Kaupunki']))
+    (tmp_path / 'b.pdf').write_bytes(b'%PDF-1.4 broken')
+    output = tmp_path / 'text.jsonl'
+    
+    extractor = TextExtractor(output, workers=1).start()
+    extractor.submit(tmp_path / 'a.pdf', 'oai:1', {'title': 'Maaseutu'})
+    extractor.submit(tmp_path / 'a.pdf', 'oai:1', {'title': 'Maaseutu'})
+    extractor.submit(tmp_path / 'b.pdf', 'oai:2')
+    extractor.join()
+    assert (extractor.extracted, extractor.failed) == (1, 1)
+    entry = json.loads(output.read_text(encoding='utf-8'))
+    assert entry['identifier'] == 'oai:1' and entry['metadata'] == {'title': 'Maaseutu'}
+    assert entry['pages'] == 2 and entry['text'].split('\f') == ['Maaseutu', 'Kaupunki']
+    
+    # Unchanged files are skipped
+    extractor = TextExtractor(output, workers=1).start()
+    extractor.submit(tmp_path / 'a.pdf', 'oai:1')
+    extractor.join()
+    assert (extractor.extracted, extractor.skipped) == (0, 1)
+    
+    (tmp_path / 'a.pdf').write_bytes(pdf(['Taajama']))
+    extractor = TextExtractor(tmp_path / 'text', workers=1).start()
+    extractor.submit(tmp_path / 'a.pdf', 'oai:1')
+    extractor.join()
+    assert (tmp_path / 'text' / 'oai_1_a.txt').read_text(encoding='utf-8') == 'Taajama'
+    
+    
+def test_TextExtractor_worker_died(tmp_path, backend):
+    for i in range(5):
+        (tmp_path / f'{i}.pdf').write_bytes(pdf([f'Sivu {i}']))
+    extractor = TextExtractor(tmp_path / 'text.jsonl', workers=1).start()
+    extractor.submit(tmp_path / '0.pdf', 'oai:0')
+    broken = extractor._executor
+    while extractor.extracted < 1:
+        time.sleep(0.05)
+    for process in list(broken._processes.values()):
+        process.kill()
+    while not broken._broken:
+        time.sleep(0.05)
+        
+    # More files than slots are submitted to a new pool
+    submitting = threading.Thread(target=lambda: [extractor.submit(tmp_path / f'{i}.pdf', f'oai:{i}') 
+                                                  for i in range(1, 5)])
+    submitting.start()
+    submitting.join(30)
+    assert not submitting.is_alive()
+    extractor.join()
+    assert extractor.extracted == 5
+    assert extractor._slots._value == 2
@@ -12,14 +12,14 @@ done
 pattern=(
   "[Mm]aa[-]?seu.*"
   "[Hh]aja-asut.*"
-  "\"[Hh]arvaan asut.*\""
+  "[Hh]arvaan asut.*"
   "[Ss]yrjä[-]?seu.*"
   "[Kk]yl[iä].*"
   "[Rr]euna-alu.*"
   "[Ss]yrjä[-]?alu.*"
   "[Rr]aja[-]?seu.*"
   "[Rr]aja-alu.*"
-  "\"[Kk]aupunkien ulko[-]?puol.*\""
+  "[Kk]aupunkien ulko[-]?puol.*"
   "[Pp]aikalli.*"
   "[Aa]lueelli.*"
   "[Kk]aupun.*"
@@ -51,6 +51,10 @@ name=(
 mkdir -p $metadata_dir
 mkdir -p $filelist_dir
 
+# All patterns are searched during a single harvest
+searchpatterns=()
 for index in ${!pattern[*]}; do 
-  oai-harvest https://julkaisut.valtioneuvosto.fi/oai/request -sp "${pattern[$index]}" -vv -m ${metadata_dir}/metadata_${name[$index]}_${suffix}.csv -f ${filelist_dir}/filelist_${name[$index]}_${suffix}.txt
+  searchpatterns+=(-sp "${name[$index]}=${pattern[$index]}")
 done
+
+oai-harvest https://julkaisut.valtioneuvosto.fi/oai/request "${searchpatterns[@]}" -vv -m "${metadata_dir}/metadata_{name}_${suffix}.csv" -f "${filelist_dir}/filelist_{name}_${suffix}.txt"
@@ -7,6 +7,6 @@ for file in $files; do
   name=${name%.txt}
   name=${name/filelist_/''}
   mkdir -p $name
-  wget -i $file -P $name
+  oai-download $file -o $name --store pdf-store --concurrency 8 --rate 4
 done
 
@@ -13,24 +13,69 @@ __version__ = "0.1.0"
 __license__ = "MIT"
 
 import argparse
+from array import array
+from contextlib import contextmanager, nullcontext
+from collections import deque, namedtuple
 import csv
+from datetime import date, timedelta
+import gzip
+import hashlib
+from functools import cache, partial
+from heapq import merge
+import importlib.util
+import json
 import logging
-from itertools import count
-import pprint
+from itertools import accumulate, chain, count
+import os
+from bisect import bisect_left
+from queue import Full, Queue
+import random
 import re
+import shutil
+import threading
 import time
 import urllib
-from urllib.parse import urlparse, unquote, quote
-import xml.etree.ElementTree as ET
+from urllib.parse import urlencode, urlparse, unquote, quote
+from html import unescape
 
-from concurrent.futures import ThreadPoolExecutor
-
-from lxml import etree
 from pathlib import Path
-import requests
 
-from sickle import Sickle
-from sickle.iterator import OAIResponseIterator
+
+class _LazyModule():
+    # Heavy modules are imported when first used so that --help, -lp and
+    # argument errors return quickly. The module replaces the proxy in
+    # module globals on first attribute access.
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+        
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attribute)
+        
+        
+asyncio = _LazyModule('asyncio', 'asyncio')
+futures = _LazyModule('concurrent.futures', 'futures')
+multiprocessing = _LazyModule('multiprocessing', 'multiprocessing')
+pprint = _LazyModule('pprint', 'pprint')
+sqlite3 = _LazyModule('sqlite3', 'sqlite3')
+etree = _LazyModule('lxml.etree', 'etree')
+requests = _LazyModule('requests', 'requests')
+sickle = _LazyModule('sickle', 'sickle')
+oaiexceptions = _LazyModule('sickle.oaiexceptions', 'oaiexceptions')
+sickle_response = _LazyModule('sickle.response', 'sickle_response')
+aiohttp = _LazyModule('aiohttp', 'aiohttp')
+
+
+OAI_NAMESPACE = '{http://www.openarchives.org/OAI/2.0/}'
+OAI_LISTRECORDS = OAI_NAMESPACE + 'ListRecords'
+OAI_RECORD = OAI_NAMESPACE + 'record'
+OAI_HEADER = OAI_NAMESPACE + 'header'
+OAI_IDENTIFIER = OAI_NAMESPACE + 'identifier'
+OAI_DATESTAMP = OAI_NAMESPACE + 'datestamp'
+KK_FIELD = '{http://kk/1.0}field'
+KK_FILE = '{http://kk/1.0}file'
 
 
 class KansallisarkistoOAI():
@@ -53,131 +98,1666 @@ class KansallisarkistoOAI():
     }
     metadata = 'kk'
 
+
+class SetRegistry():
+    # Sets of the service from ListSets as {setName: setSpec}, cached on disk
+    # per endpoint for ttl hours so that publishers are looked up without a
+    # request on every run. Communities (com_) win over collections with the
+    # same name. A stale cache is used if the service can not be reached, and
+    # the built-in sets_lookup if there is no cache at all. Offline the cache
+    # is used whatever its age.
+    def __init__(self, endpoint, ttl=24, cache_dir=None, offline=False):
+        self.endpoint = endpoint
+        self.ttl = ttl
+        self.cache_dir = Path(cache_dir) if cache_dir else self.default_cache_dir()
+        self.offline = offline
+        self._lookup = None
+        
+    @staticmethod
+    def default_cache_dir():
+        return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'webscraper' / 'sets'
+        
+    @property
+    def filepath(self):
+        return self.cache_dir / (hashlib.sha1(self.endpoint.encode('utf-8')).hexdigest()[:16] + '.json')
+        
+    @property
+    def lookup(self):
+        if self._lookup is None:
+            sets = self._sets()
+            self._lookup = self._names(sets) if sets is not None else dict(KansallisarkistoOAI.sets_lookup)
+        return self._lookup
+        
+    # Publisher names or setSpecs to setSpecs, ValueError for unknown ones
+    def resolve(self, sets):
+        specs = set(self.lookup.values())
+        unknown = [name for name in sets if name not in self.lookup and name not in specs]
+        if unknown:
+            raise ValueError(f"Unknown publishers: {', '.join(unknown)}")
+        return [self.lookup.get(name, name) for name in sets]
+        
+    # Sets of cache or service, None for the built-in sets_lookup
+    def _sets(self):
+        cached = self._load()
+        if cached is not None and (self.offline or time.time() - cached['fetched'] < self.ttl * 3600):
+            return cached['sets']
+        if not self.offline:
+            try:
+                sets = self.fetch()
+                self._save(sets)
+                return sets
+            except Exception as ex:
+                logging.warning("ListSets failed: %s", ex)
+        if cached is not None:
+            logging.warning("Using sets cached at %s", time.ctime(cached['fetched']))
+            return cached['sets']
+        logging.warning("Using built-in publisher sets")
+        return None
+        
+    # Sets of the service as {setSpec: setName}
+    def fetch(self):
+        logging.info("Listing sets of: %s", self.endpoint)
+        return {oai_set.setSpec: oai_set.setName for oai_set in sickle.Sickle(self.endpoint).ListSets()}
+        
+    @staticmethod
+    def _names(sets):
+        lookup = {}
+        for spec, name in sets.items():
+            if name not in lookup or (spec.startswith('com_') and not lookup[name].startswith('com_')):
+                lookup[name] = spec
+        return lookup
+        
+    def _load(self):
+        try:
+            with open(self.filepath, encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cached if cached.get('endpoint') == self.endpoint else None
+        
+    def _save(self, sets):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.filepath.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'endpoint': self.endpoint, 'fetched': time.time(), 'sets': sets}, f, ensure_ascii=False)
+        os.replace(tmp, self.filepath)
+
+
 class Records(KansallisarkistoOAI):
     default_params = {'metadataPrefix': 'kk' , 
                       'ignore_deleted': True}
+    # Max number of records waiting in buffer when harvesting concurrently
+    buffer_size = 1000
+    shard_modes = ['year', 'month', 'auto']
+    # Seconds to wait for a response over a shared session
+    timeout = 300
                       
     # Initialize with all records
-    def __init__(self, endpoint, sets):
+    def __init__(self, endpoint, sets, workers=1, shard=None, shard_size=10000, state=None,
+                 cache=None, offline=False, seen=None, metrics=None, parse_workers=0, record_filter=None,
+                 keep_metadata=False, sets_lookup=None, metadata_prefix=None, session=None, scheduler=None):
         logging.info("Connected to: %s", endpoint)
-        self.oai_service = Sickle(endpoint)
+        self.endpoint = endpoint
+        self.oai_service = sickle.Sickle(endpoint)
+        self.session = session
+        self.scheduler = scheduler
         #self.params = []
         self.records = []
         self.idx = 0
         self.sets = sets
+        self.workers = workers
+        self.shard = shard
+        self.shard_size = shard_size
+        self.state = state
+        self.cache = cache
+        self.offline = offline
+        if offline and cache is None:
+            raise ValueError("Offline harvest needs a response cache")
+        self.until = date.today()
+        self.resuming = False
+        self._earliest = None
+        # Records handled in this run (kept with the state of an unfinished
+        # run) and records exported on earlier runs
+        self.handled = state.handled() if state is not None else SeenSet()
+        self.seen = seen
+        self.metrics = metrics if metrics is not None else _null_metrics
+        self.parse_workers = parse_workers
+        self.record_filter = record_filter
+        self.keep_metadata = keep_metadata
+        if sets_lookup is not None:
+            self.sets_lookup = sets_lookup
+        if metadata_prefix is not None:
+            self.metadata = metadata_prefix
+        self._parser = None
+        self._positions = {}
+        self._marks = {}
+        self._pending = None
+        self._finished = False
+        self._executor = None
+        self._stop = threading.Event()
         self.list_records()
         
     # Helper function for list_records
     def _create_param_sets(self):
-        if self.sets is not None:           
-            return [{**Records.default_params, 'set': self.sets_lookup[set]} for set in self.sets]
+        if self.sets is not None:
+            # Several publishers may share a set, setSpecs are used as is
+            set_ids = dict.fromkeys(self.sets_lookup.get(set, set) for set in self.sets)
+            return [{**Records.default_params, 'metadataPrefix': self.metadata, 'set': set_id} for set_id in set_ids]
         else:
-            return [{**Records.default_params}]
+            return [{**Records.default_params, 'metadataPrefix': self.metadata}]
     
-    # Initializer for records
+    # Initializer for records, each set (or date window of a set when sharding)
+    # is harvested by its own generator. With state, harvest starts from the
+    # last harvested datestamp or continues an interrupted run.
     def list_records(self):
+        self._resume()
         for param_set in self._create_param_sets():
-            self.records.append(self.oai_service.ListRecords(**param_set))
+            start = self._start(param_set)
+            windows = self._create_windows(start) if self.shard else [None]
+            for window in windows:
+                source = self._source(param_set, window, start)
+                if source is not None:
+                    self.records.append(source)
+        if self.scheduler is not None:
+            self._stream = self.scheduler.stream(self, self.records)
+        elif self.workers > 1:
+            self._stream = self._concurrent(self.records)
+        else:
+            self._stream = self._serial(self.records)
+        if self.parse_workers:
+            self._stream = self._parallel(self._stream)
+            
+    # Continue checkpointed run of state
+    def _resume(self):
+        run = self.state.run if self.state is not None else None
+        if run is not None:
+            logging.info("Resuming interrupted harvest")
+            self.resuming = True
+            self.until = date.fromisoformat(run['until'])
+            self._positions = dict(run['sources'])
+            self._marks = dict(run['marks'])
+            
+    # Last harvested date of a set
+    def _start(self, param_set):
+        mark = self.state.mark(self._mark_key(param_set)) if self.state is not None else None
+        return date.fromisoformat(mark[:10]) if mark else None
+            
+    # Harvest continuing from checkpoint, None if it was already completed
+    def _source(self, param_set, window, start=None):
+        position = self._positions.get(self._source_key(param_set, window))
+        if position == 'done':
+            return None
+        return self._harvest(param_set, window, start, position)
+            
+    # State keys: (endpoint, set, metadataPrefix) and date window of a shard
+    def _mark_key(self, param_set):
+        return "|".join([self.endpoint, param_set.get('set', ''), param_set['metadataPrefix']])
+        
+    def _source_key(self, param_set, window):
+        if window is None:
+            return self._mark_key(param_set)
+        return "|".join([self._mark_key(param_set), window[0].isoformat(), window[1].isoformat()])
+            
+    # Date windows from repository's earliest datestamp (or given start) until today
+    def _create_windows(self, start=None):
+        if self._earliest is None:
+            self._earliest = self._earliest_date(self._request({'verb': 'Identify'}))
+        return self._windows(max(self._earliest, start or self._earliest), self._window_end(), self.shard)
+        
+    # Last window ends on the day of the harvest recorded to the cache when
+    # offline, so that the requests are the same as in the recorded harvest
+    def _window_end(self):
+        if self.offline and not self.resuming:
+            until = self.cache.until(self.endpoint)
+            if until is not None:
+                self.until = date.fromisoformat(until)
+        elif self.cache is not None:
+            self.cache.set_until(self.endpoint, self.until)
+        return self.until
+        
+    @staticmethod
+    def _earliest_date(identify):
+        earliest = identify.find('.//' + OAI_NAMESPACE + 'earliestDatestamp')
+        return date.fromisoformat(earliest.text[:10])
+        
+    # Non-overlapping (from, until) windows, both ends inclusive as in OAI-PMH
+    @staticmethod
+    def _windows(start, end, shard):
+        if shard == 'auto':
+            return [(start, end)]
+        windows = []
+        while start <= end:
+            if shard == 'year':
+                next_start = date(start.year + 1, 1, 1)
+            else:
+                next_start = date(start.year + start.month // 12, start.month % 12 + 1, 1)
+            windows.append((start, min(next_start - timedelta(days=1), end)))
+            start = next_start
+        return windows
+        
+    # Single OAI-PMH request, errors are raised as sickle's OAI exceptions
+    def _request(self, params):
+        content = self._fetch(params)
+        with self.metrics.timer('parse_page_seconds'):
+            return self._parse(content)
+        
+    @staticmethod
+    def _parse(content):
+        xml = etree.XML(content, parser=sickle_response.XMLParser)
+        error = xml.find(OAI_NAMESPACE + 'error')
+        if error is not None:
+            code = error.get('code', 'UNKNOWN')
+            exception = getattr(oaiexceptions, code[0].upper() + code[1:], oaiexceptions.OAIError)
+            raise exception(error.text or '')
+        return xml
+        
+    # Unparsed response for parse workers, OAI errors are still raised here
+    def _request_raw(self, params):
+        content = self._fetch(params)
+        if _error_tag.search(content):
+            self._parse(content)
+        return content
+        
+    # Raw response from the service, or from the cache when offline
+    def _fetch(self, params):
+        if self.offline:
+            return self._cached(params)
+        with self.metrics.timer('oai_request_seconds'):
+            if self.session is not None:
+                content = self._session_request(params)
+            else:
+                content = self.oai_service.harvest(**params).http_response.content
+        self.metrics.count('oai_requests')
+        self.metrics.count('oai_bytes', len(content))
+        if self.cache is not None:
+            self.cache.put(self.endpoint, params, content)
+        return content
+        
+    # Request over a shared keep-alive session, eg. of a Scheduler
+    def _session_request(self, params):
+        response = self.session.get(self.endpoint, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+        
+    def _cached(self, params):
+        content = self.cache.get(self.endpoint, params)
+        if content is None:
+            raise CacheMiss(f"No cached response for {self.endpoint} {params}")
+        self.metrics.count('cache_hits')
+        return content
+        
+    # Next resumption token and completeListSize of a list response
+    @staticmethod
+    def _resumption(xml, verb='ListRecords'):
+        resumption_token = xml.find(OAI_NAMESPACE + verb + '/' + OAI_NAMESPACE + 'resumptionToken')
+        if resumption_token is None:
+            return None, None
+        return resumption_token.text, resumption_token.get('completeListSize')
+        
+    # Resumption token and completeListSize without parsing the page
+    @staticmethod
+    def _resumption_raw(content):
+        match = _resumption_tag.search(content)
+        if match is None:
+            return None, None
+        size = re.search(rb'completeListSize="(\d+)"', match.group(1))
+        token = match.group(2).decode('utf-8') if match.group(2) else ''
+        token = unescape(token.strip())
+        return token or None, size.group(1).decode('ascii') if size else None
+        
+    # ListRecords pages as (resumption token used for the page, completeListSize, xml),
+    # with parse workers xml is the unparsed response
+    def _pages(self, params, token=None):
+        while True:
+            if token:
+                request = {'verb': 'ListRecords', 'resumptionToken': token}
+            else:
+                request = {'verb': 'ListRecords', **params}
+            if self.parse_workers:
+                xml = self._request_raw(request)
+                next_token, size = self._resumption_raw(xml)
+            else:
+                xml = self._request(request)
+                next_token, size = self._resumption(xml)
+            yield token, size, xml
+            if not next_token:
+                return
+            token = next_token
+            
+    # Follow resumption tokens of a single set, shards which are larger than
+    # shard_size are split in half. Position is the [token, count] checkpoint of
+    # an interrupted run: count records of the page fetched with token are skipped.
+    def _harvest(self, param_set, window=None, start=None, position=None):
+        params = self._params(param_set, window, start)
+        key = self._source_key(param_set, window)
+        mark = self._mark_key(param_set)
+        token, skip = position or (None, 0)
+        pages = self._pages(params, token)
+        try:
+            try:
+                page = next(pages)
+            except oaiexceptions.BadResumptionToken:
+                logging.warning("Checkpoint of %s has expired, starting from first page, "
+                                "skipping records already output", key)
+                token, skip = None, 0
+                pages = self._pages(params)
+                page = next(pages)
+        except oaiexceptions.NoRecordsMatch:
+            logging.info("No records in set %s %s", param_set.get('set'), window or '')
+            yield _End(key)
+            return
+        token, size, xml = page
+        if self._oversized(window, token, size):
+            yield self._split(param_set, window, size)
+            return
+        for token, size, xml in chain([page], pages):
+            if self.parse_workers:
+                yield _RawPage(key, mark, token, xml, skip, bool(param_set.get('ignore_deleted')))
+            else:
+                yield from self._items(param_set, key, mark, token, xml, skip)
+            skip = 0
+        yield _End(key)
+        
+    # Request parameters of a set limited to window or from start date
+    @staticmethod
+    def _params(param_set, window=None, start=None):
+        params = {key: value for key, value in param_set.items() if key != 'ignore_deleted'}
+        if window is not None:
+            params.update({'from': window[0].isoformat(), 'until': window[1].isoformat()})
+        elif start is not None:
+            params['from'] = start.isoformat()
+        return params
+        
+    # First page of a shard tells if it has to be split
+    def _oversized(self, window, token, size):
+        if window is None or window[0] >= window[1] or token is not None:
+            return False
+        return size is not None and int(size) > self.shard_size
+        
+    def _split(self, param_set, window, size):
+        start, end = window
+        middle = start + (end - start) // 2
+        logging.info("Splitting shard %s - %s with %s records", start, end, size)
+        sources = [self._source(param_set, (start, middle)),
+                   self._source(param_set, (middle + timedelta(days=1), end))]
+        return _Split([source for source in sources if source is not None])
+        
+    # Records of a page, skip first records already handled before checkpoint
+    @staticmethod
+    def _items(param_set, key, mark, token, xml, skip=0):
+        items = []
+        index = 0
+        for element in xml.iterfind(OAI_LISTRECORDS + '/' + OAI_RECORD):
+            header = element.find(OAI_HEADER)
+            if param_set.get('ignore_deleted') and header.get('status') == 'deleted':
+                continue
+            index += 1
+            if index > skip:
+                items.append(_Item(key, mark, token, index, header.findtext(OAI_IDENTIFIER), 
+                                   header.findtext(OAI_DATESTAMP), element))
+        return items
+        
+    # Pages are parsed and filtered in worker processes, some pages ahead
+    # of the iterator. Results are returned in the order of the pages.
+    def _parallel(self, stream):
+        record_filter = self.record_filter or RecordFilter()
+        self._parser = futures.ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=_mp_context(),
+                                           initializer=_init_parse_worker,
+                                           initargs=(record_filter.language, record_filter.patterns, 
+                                                     self.keep_metadata))
+        pending = deque()
+        try:
+            for item in stream:
+                if isinstance(item, _RawPage):
+                    pending.append((item, self._parser.submit(_parse_page, item.content, item.skip, 
+                                                              item.ignore_deleted)))
+                else:
+                    pending.append((item, None))
+                if self.metrics:
+                    self.metrics.gauge('parse_queue', len(pending))
+                while pending and (len(pending) > self.parse_workers * 2 or pending[0][1] is None):
+                    yield from self._parsed(*pending.popleft())
+            while pending:
+                yield from self._parsed(*pending.popleft())
+        finally:
+            self._parser.shutdown(cancel_futures=True)
+            
+    @staticmethod
+    def _parsed(item, future):
+        if future is None:
+            yield item
+            return
+        for index, identifier, datestamp, parsed in future.result():
+            yield _Item(item.key, item.mark, item.token, index, identifier, datestamp, parsed)
+            
+    def _serial(self, sources):
+        for source in sources:
+            for item in source:
+                if isinstance(item, _Split):
+                    yield from self._serial(item.sources)
+                else:
+                    yield item
+        
+    # Run each harvest in worker thread and merge them into one stream
+    def _concurrent(self, sources):
+        buffer = Queue(maxsize=self.buffer_size)
+        self._executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+        for source in sources:
+            self._executor.submit(self._worker, source, buffer)
+        pending = len(sources)
+        while pending:
+            item = buffer.get()
+            if self.metrics:
+                self.metrics.gauge('record_buffer', buffer.qsize())
+            if item is _DONE:
+                pending -= 1
+            elif isinstance(item, _Split):
+                for source in item.sources:
+                    self._executor.submit(self._worker, source, buffer)
+                pending += len(item.sources)
+            elif isinstance(item, Exception):
+                self.close()
+                raise item
+            else:
+                yield item
+        self.close()
+        
+    def _worker(self, source, buffer):
+        try:
+            for item in source:
+                if not self._put(buffer, item):
+                    return
+        except Exception as ex:
+            logging.warning(f'Harvest failed with error: {ex}')
+            self._put(buffer, ex)
+        finally:
+            self._put(buffer, _DONE)
+            
+    # Blocks while buffer is full, gives up when harvest is closed
+    def _put(self, buffer, item):
+        while not self._stop.is_set() and threading.main_thread().is_alive():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+        
+    def close(self):
+        self._stop.set()
+        if self.scheduler is not None:
+            self.scheduler.remove(self)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._parser is not None:
+            self._parser.shutdown(cancel_futures=True)
+            
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *exc):
+        self.close()
+        
+    # Save position of records handled so far to state. Call after output of
+    # the handled records has been written: the record returned last by
+    # next() counts as handled only when next record has been requested.
+    def checkpoint(self):
+        with self.metrics.timer('checkpoint_seconds'):
+            self._checkpoint()
+            
+    # Without state the next run writes its outputs over, so exported records
+    # are saved to seen set only when the run has completed.
+    def _checkpoint(self):
+        if self.seen is not None and self.seen.filepath is not None and (self.state is not None or self._finished):
+            self.seen.save()
+        if self.state is None:
+            return
+        if self._finished:
+            self.state.finish(self._marks)
+        else:
+            self.state.update(self.until, self._positions, self._marks)
+            self.handled.save()
+        self.state.save()
+        if self._finished:
+            self.handled.filepath.unlink(missing_ok=True)
+        
+    # Previous record has been handled when next one is requested
+    def _commit(self):
+        if self._pending is None:
+            return
+        item = self._pending
+        self.handled.add(item.identifier)
+        self._positions[item.key] = [item.token, item.index]
+        datestamp = item.datestamp
+        if datestamp and datestamp > self._marks.get(item.mark, ''):
+            self._marks[item.mark] = datestamp
+        self._pending = None
     
     # Custom iterator
     def __iter__(self):
         return self
         
-    # Transform each item to Record class
+    # Transform each item to Record class. Sets and shards may overlap and
+    # records may have been exported on earlier runs (with a persistent
+    # seen set), records already handled or exported are skipped.
     def __next__(self):
-        for records in self.records:
-            record = records.next()
-            if record is not None:
-                self.idx += 1
-                return Record(record)
+        self._commit()
+        while True:
+            try:
+                item = next(self._stream)
+            except StopIteration:
+                self._finished = True
+                raise
+            if isinstance(item, _End):
+                self._positions[item.key] = 'done'
+                continue
+            if item.identifier in self.handled or (self.seen is not None and item.identifier in self.seen):
+                logging.debug("Skipping duplicate record %s", item.identifier)
+                self._positions[item.key] = [item.token, item.index]
+                self.metrics.count('records_duplicate')
+                continue
+            self._pending = item
+            self.idx += 1
+            if self.metrics:
+                self.metrics.count('records_seen')
+            if isinstance(item.record, _Parsed):
+                return Record.from_metadata(item.identifier, item.datestamp, *item.record)
+            return Record(item.record)
+            
+    # Record has been written to the outputs, with a seen set it is skipped
+    # on later runs
+    def exported(self, record):
+        if self.seen is not None:
+            self.seen.add(record.identifier)
+            
+    # Records accepted by predicate, eg. RecordFilter
+    def filter(self, predicate):
+        for record in self:
+            if predicate(record):
+                yield record
+
+
+# Marks end of a harvest in the concurrent buffer
+_DONE = object()
+
+
+# Record with its position in a harvest
+_Item = namedtuple('_Item', ['key', 'mark', 'token', 'index', 'identifier', 'datestamp', 'record'])
+
+
+# Unparsed page for parse workers
+_RawPage = namedtuple('_RawPage', ['key', 'mark', 'token', 'content', 'skip', 'ignore_deleted'])
+
+
+# Record parsed and filtered in a parse worker, metadata of rejected records
+# is kept only when needed
+_Parsed = namedtuple('_Parsed', ['metadata', 'matches', 'accepted'])
+
+
+_error_tag = re.compile(rb'<(?:\w+:)?error[\s>]')
+_resumption_tag = re.compile(rb'<(?:\w+:)?resumptionToken([^>]*?)(?:/>|>([^<]*)</(?:\w+:)?resumptionToken>)')
+
+
+# Start method of worker processes. Pools are started while harvest and
+# download threads are running and forking a threaded process may deadlock.
+def _mp_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _init_parse_worker(language, patterns, keep_metadata):
+    global _worker_filter, _worker_keep_metadata
+    _worker_filter = RecordFilter(language, patterns)
+    _worker_keep_metadata = keep_metadata
+    
+    
+# Parse worker: filter records of a page, returns
+# (index, identifier, datestamp, _Parsed) of records after skip
+def _parse_page(content, skip, ignore_deleted):
+    xml = etree.XML(content, parser=sickle_response.XMLParser)
+    results = []
+    index = 0
+    for element in xml.iterfind(OAI_LISTRECORDS + '/' + OAI_RECORD):
+        header = element.find(OAI_HEADER)
+        if ignore_deleted and header.get('status') == 'deleted':
+            continue
+        index += 1
+        if index <= skip:
+            continue
+        record = Record(element)
+        accepted = _worker_filter(record)
+        metadata = record.metadata if accepted or _worker_keep_metadata else None
+        results.append((index, record.identifier, record.datestamp, _Parsed(metadata, record.matches, accepted)))
+    return results
+
+
+# Harvest of a set or shard is complete
+class _End():
+    def __init__(self, key):
+        self.key = key
+
+
+# Shard split into smaller shards
+class _Split():
+    def __init__(self, sources):
+        self.sources = sources
+        
+        
+class AsyncRecords(Records):
+    # Records harvested with asyncio instead of Sickle. All sets and shards
+    # are requested concurrently on one event loop, workers limits number of
+    # requests in flight over keep-alive connections. The loop runs in a
+    # background thread and pages are passed to the iterator through a
+    # bounded buffer, so AsyncRecords is used like Records.
+    def __init__(self, endpoint, sets, workers=100, **kwargs):
+        if importlib.util.find_spec('aiohttp') is None:
+            raise ImportError("AsyncRecords needs aiohttp, install with: pip install webscraper[async]")
+        self._session = None
+        self._thread = None
+        super().__init__(endpoint, sets, workers=workers, **kwargs)
+        
+    # Sources are created on the event loop when iteration starts
+    def list_records(self):
+        self._resume()
+        self._stream = self._bridge()
+        if self.parse_workers:
+            self._stream = self._parallel(self._stream)
+        
+    def _source(self, param_set, window, start=None):
+        position = self._positions.get(self._source_key(param_set, window))
+        if position == 'done':
+            return None
+        return self._aharvest(param_set, window, start, position)
+        
+    async def _sources(self):
+        sources = []
+        for param_set in self._create_param_sets():
+            start = self._start(param_set)
+            windows = await self._acreate_windows(start) if self.shard else [None]
+            for window in windows:
+                source = self._source(param_set, window, start)
+                if source is not None:
+                    sources.append(source)
+        return sources
+        
+    async def _acreate_windows(self, start=None):
+        if self._earliest is None:
+            self._earliest = self._earliest_date(await self.identify())
+        return self._windows(max(self._earliest, start or self._earliest), self._window_end(), self.shard)
+        
+    async def identify(self):
+        return await self._arequest({'verb': 'Identify'})
+        
+    # Sets of the repository as {setSpec: setName}
+    async def list_sets(self):
+        sets = {}
+        params = {'verb': 'ListSets'}
+        while True:
+            xml = await self._arequest(params)
+            for element in xml.iterfind('.//' + OAI_NAMESPACE + 'set'):
+                sets[element.findtext(OAI_NAMESPACE + 'setSpec')] = element.findtext(OAI_NAMESPACE + 'setName')
+            token, _ = self._resumption(xml, 'ListSets')
+            if not token:
+                return sets
+            params = {'verb': 'ListSets', 'resumptionToken': token}
+            
+    # Run coroutine function with a connection to the service, eg.
+    # records.run(records.list_sets)
+    def run(self, function):
+        async def connected():
+            async with self._connect():
+                return await function()
+        return asyncio.run(connected())
+        
+    def _connect(self):
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.workers, limit_per_host=self.workers),
+            timeout=aiohttp.ClientTimeout(total=300))
+        return self._session
+            
+    async def _arequest(self, params):
+        content = await self._afetch(params)
+        with self.metrics.timer('parse_page_seconds'):
+            return self._parse(content)
+        
+    async def _afetch(self, params):
+        if self.offline:
+            return self._cached(params)
+        start = time.perf_counter()
+        async with self._session.get(self.endpoint, params=params) as response:
+            response.raise_for_status()
+            content = await response.read()
+        self.metrics.observe('oai_request_seconds', time.perf_counter() - start)
+        self.metrics.count('oai_requests')
+        self.metrics.count('oai_bytes', len(content))
+        if self.cache is not None:
+            self.cache.put(self.endpoint, params, content)
+        return content
+        
+    # Next page as (token used for the page, completeListSize, next token, xml)
+    async def _apage(self, params, token=None):
+        if token:
+            request = {'verb': 'ListRecords', 'resumptionToken': token}
+        else:
+            request = {'verb': 'ListRecords', **params}
+        if self.parse_workers:
+            xml = await self._afetch(request)
+            if _error_tag.search(xml):
+                self._parse(xml)
+            next_token, size = self._resumption_raw(xml)
+        else:
+            xml = await self._arequest(request)
+            next_token, size = self._resumption(xml)
+        return token, size, next_token, xml
+        
+    # Same as Records._harvest, but yields records of a page at once
+    async def _aharvest(self, param_set, window=None, start=None, position=None):
+        params = self._params(param_set, window, start)
+        key = self._source_key(param_set, window)
+        mark = self._mark_key(param_set)
+        token, skip = position or (None, 0)
+        try:
+            try:
+                page = await self._apage(params, token)
+            except oaiexceptions.BadResumptionToken:
+                logging.warning("Checkpoint of %s has expired, starting from first page, "
+                                "skipping records already output", key)
+                skip = 0
+                page = await self._apage(params)
+        except oaiexceptions.NoRecordsMatch:
+            logging.info("No records in set %s %s", param_set.get('set'), window or '')
+            yield [_End(key)]
+            return
+        token, size, next_token, xml = page
+        if self._oversized(window, token, size):
+            yield self._split(param_set, window, size)
+            return
+        while True:
+            if self.parse_workers:
+                items = [_RawPage(key, mark, token, xml, skip, bool(param_set.get('ignore_deleted')))]
+            else:
+                items = self._items(param_set, key, mark, token, xml, skip)
+            skip = 0
+            if not next_token:
+                yield items + [_End(key)]
+                return
+            yield items
+            token, size, next_token, xml = await self._apage(params, next_token)
+            
+    async def _run(self, buffer):
+        async with self._connect():
+            async with asyncio.TaskGroup() as group:
+                async def harvest(source):
+                    async for page in source:
+                        if isinstance(page, _Split):
+                            for child in page.sources:
+                                group.create_task(harvest(child))
+                        elif not await asyncio.to_thread(self._put, buffer, page):
+                            return
+                for source in await self._sources():
+                    group.create_task(harvest(source))
+                    
+    def _loop(self, buffer):
+        try:
+            asyncio.run(self._run(buffer))
+        except BaseException as ex:
+            while isinstance(ex, BaseExceptionGroup):
+                ex = ex.exceptions[0]
+            logging.warning(f'Harvest failed with error: {ex}')
+            self._put(buffer, ex)
+        finally:
+            self._put(buffer, _DONE)
+            
+    # Pages from the event loop to the iterator
+    def _bridge(self):
+        buffer = Queue(maxsize=max(1, self.buffer_size // 100))
+        self._thread = threading.Thread(target=self._loop, args=(buffer,), daemon=True)
+        self._thread.start()
+        while True:
+            page = buffer.get()
+            if self.metrics:
+                self.metrics.gauge('record_buffer', buffer.qsize())
+            if page is _DONE:
+                break
+            if isinstance(page, BaseException):
+                self.close()
+                raise page
+            yield from page
+        self.close()
+
+
+class _Harvest():
+    # Sources of one Records in a Scheduler, ready sources as (items of the
+    # next page already taken from source, source)
+    def __init__(self, records, sources, cap):
+        self.records = records
+        self.ready = deque(((), source) for source in sources)
+        self.cap = cap
+        self.running = 0
+        self.buffer = Queue(maxsize=records.buffer_size)
+
+
+class Scheduler():
+    # Harvests of several endpoints share one pool of worker threads and one
+    # keep-alive session. Workers take turns between the harvests one page at a
+    # time and a harvest has at most cap (its workers) sources running, so a
+    # slow repository can hold only its own share of the pool. Records created
+    # with scheduler=... get their records through the scheduler:
+    #   scheduler = Scheduler(8).start()
+    #   records = Records(url, sets, workers=2, session=scheduler.session, scheduler=scheduler)
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._harvests = []
+        self._next = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._threads = []
+
+    def start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.session.close()
+
+    # Records of sources merged into one stream, like Records._concurrent
+    def stream(self, records, sources):
+        harvest = _Harvest(records, sources, max(1, records.workers))
+        with self._condition:
+            self._harvests.append(harvest)
+            self._condition.notify_all()
+        return self._stream(harvest, len(sources))
+
+    # Harvest leaves the rotation when it is done, fails or the consumer stops,
+    # sources left unfinished are closed
+    def _stream(self, harvest, pending):
+        try:
+            while pending:
+                item = harvest.buffer.get()
+                if harvest.records.metrics:
+                    harvest.records.metrics.gauge('record_buffer', harvest.buffer.qsize())
+                if item is _DONE:
+                    pending -= 1
+                elif isinstance(item, _Split):
+                    pending += len(item.sources)
+                elif isinstance(item, Exception):
+                    harvest.records.close()
+                    raise item
+                else:
+                    yield item
+        finally:
+            if pending:
+                harvest.records._stop.set()
+            with self._condition:
+                self._drop(harvest)
+                
+    # Harvest of records stopped, eg. closed before the end
+    def remove(self, records):
+        with self._condition:
+            for harvest in [harvest for harvest in self._harvests if harvest.records is records]:
+                self._drop(harvest)
+            
+    # Remove harvest from rotation and close its waiting sources, sources
+    # taken by workers are closed by them
+    def _drop(self, harvest):
+        if harvest in self._harvests:
+            self._harvests.remove(harvest)
+        while harvest.ready:
+            harvest.ready.popleft()[1].close()
+
+    # Next harvest in turn with a source ready and less than cap running
+    def _take(self):
+        for harvest in [harvest for harvest in self._harvests if harvest.records._stop.is_set()]:
+            self._drop(harvest)
+        for i in range(len(self._harvests)):
+            harvest = self._harvests[(self._next + i) % len(self._harvests)]
+            if harvest.ready and harvest.running < harvest.cap:
+                self._next = (self._next + i + 1) % len(self._harvests)
+                harvest.running += 1
+                return harvest, harvest.ready.popleft()
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                taken = self._take()
+                while taken is None and not self._closed:
+                    self._condition.wait()
+                    taken = self._take()
+                if taken is None:
+                    return
+            harvest, (head, source) = taken
+            try:
+                head = self._turn(harvest, head, source)
+            except Exception as ex:
+                logging.warning(f'Harvest of {harvest.records.endpoint} failed with error: {ex}')
+                harvest.records._put(harvest.buffer, ex)
+                head = None
+            if head is None:
+                source.close()
+                harvest.records._put(harvest.buffer, _DONE)
+            with self._condition:
+                harvest.running -= 1
+                if head is not None and not harvest.records._stop.is_set():
+                    harvest.ready.append((head, source))
+                elif head is not None:
+                    source.close()
+                self._condition.notify_all()
+
+    # Pass items of the current page (after head) to the buffer. Returns the
+    # first item of the next page as the next head when it has been fetched,
+    # None when source is done.
+    def _turn(self, harvest, head, source):
+        records = harvest.records
+        token = None
+        for n, item in enumerate(chain(head, source)):
+            if isinstance(item, _Split):
+                # Split sources are counted by the stream before they can finish
+                if not records._put(harvest.buffer, item):
+                    return None
+                with self._condition:
+                    harvest.ready.extend(((), split) for split in item.sources)
+                    self._condition.notify_all()
+                continue
+            if isinstance(item, (_Item, _RawPage)):
+                if n and item.token != token:
+                    return [item]
+                token = item.token
+            if not records._put(harvest.buffer, item):
+                return None
+        return None
+
+
+class SeenSet():
+    # Compact set of OAI identifiers. Identifiers are kept as 64-bit blake2b
+    # digests in a sorted array (8 bytes each), new digests are collected to
+    # a set and merged to the array in batches. With filepath the digests are
+    # loaded from and saved to a file to skip records of earlier runs.
+    merge_size = 100000
+    
+    def __init__(self, filepath=None):
+        self._filepath = Path(filepath) if filepath is not None else None
+        self._digests = array('Q')
+        self._buffer = set()
+        if self._filepath is not None and self._filepath.exists():
+            with open(self._filepath, 'rb') as f:
+                self._digests.frombytes(f.read())
+            logging.info("Loaded %s seen records from %s", len(self._digests), self._filepath)
+                
+    @property
+    def filepath(self):
+        return self._filepath
+        
+    @staticmethod
+    def _digest(identifier):
+        return int.from_bytes(hashlib.blake2b(identifier.encode('utf-8'), digest_size=8).digest(), 'little')
+        
+    def _contains(self, digest):
+        if digest in self._buffer:
+            return True
+        i = bisect_left(self._digests, digest)
+        return i < len(self._digests) and self._digests[i] == digest
+        
+    def __contains__(self, identifier):
+        return self._contains(self._digest(identifier))
+        
+    def __len__(self):
+        return len(self._digests) + len(self._buffer)
+        
+    def add(self, identifier):
+        digest = self._digest(identifier)
+        if self._contains(digest):
+            return
+        self._buffer.add(digest)
+        # Merging costs a pass over the array, merge less often as it grows
+        if len(self._buffer) >= max(self.merge_size, len(self._digests) // 8):
+            self._merge()
+            
+    def _merge(self):
+        if self._buffer:
+            self._digests = array('Q', merge(self._digests, sorted(self._buffer)))
+            self._buffer.clear()
+            
+    def save(self):
+        self._merge()
+        tmp = self._filepath.with_name(self._filepath.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            self._digests.tofile(f)
+        os.replace(tmp, self._filepath)
+
+
+class CacheMiss(LookupError):
+    pass
+    
+    
+class ResponseCache():
+    # On-disk cache of raw OAI-PMH responses. Responses are stored gzipped
+    # under their sha256 (identical pages are stored once) and an sqlite
+    # index maps requests to them. Least recently used responses are
+    # evicted when size of the cache exceeds max_size bytes.
+    def __init__(self, directory, max_size=1024**3):
+        self._directory = Path(directory)
+        self.max_size = max_size
+        (self._directory / 'objects').mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self._directory / 'index.db', check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS responses 
+                            (key TEXT PRIMARY KEY, digest TEXT, size INTEGER, used REAL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_digest ON responses (digest)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS harvests (endpoint TEXT PRIMARY KEY, until TEXT)")
+        self._db.commit()
+        row = self._db.execute("SELECT SUM(size) FROM (SELECT DISTINCT digest, size FROM responses)").fetchone()
+        self._size = row[0] or 0
+        
+    @property
+    def directory(self):
+        return self._directory
+        
+    @staticmethod
+    def _key(endpoint, params):
+        request = endpoint + '?' + urlencode(sorted(params.items()))
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+        
+    def _path(self, digest):
+        return self._directory / 'objects' / digest[:2] / (digest + '.xml.gz')
+        
+    def get(self, endpoint, params):
+        key = self._key(endpoint, params)
+        with self._lock:
+            row = self._db.execute("SELECT digest FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+        try:
+            with gzip.open(self._path(row[0]), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            logging.warning("Cached response %s is missing", row[0])
+            return None
+            
+    def put(self, endpoint, params, content):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._path(digest)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            tmp = path.with_name(f'{path.name}.{threading.get_ident()}.tmp')
+            with gzip.open(tmp, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, path)
+        key = self._key(endpoint, params)
+        size = path.stat().st_size
+        with self._lock:
+            old = self._db.execute("SELECT digest, size FROM responses WHERE key = ?", (key,)).fetchone()
+            if not self._referenced(digest):
+                self._size += size
+            self._db.execute("REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, digest, size, time.time()))
+            if old is not None and old[0] != digest and not self._referenced(old[0]):
+                self._size -= old[1]
+            self._db.commit()
+            self._evict()
+            
+    def _referenced(self, digest):
+        return self._db.execute("SELECT 1 FROM responses WHERE digest = ?", (digest,)).fetchone() is not None
+            
+    # Last day of date windows of the latest sharded harvest of endpoint
+    def until(self, endpoint):
+        with self._lock:
+            row = self._db.execute("SELECT until FROM harvests WHERE endpoint = ?", (endpoint,)).fetchone()
+        return row[0] if row is not None else None
+        
+    def set_until(self, endpoint, until):
+        with self._lock:
+            self._db.execute("REPLACE INTO harvests VALUES (?, ?)", (endpoint, until.isoformat()))
+            self._db.commit()
+            
+    # Size of stored responses, each file counted once. Kept up to date on
+    # put and eviction, summed from the index only when the cache is opened.
+    @property
+    def size(self):
+        return self._size
+            
+    def _evict(self):
+        size = self._size
+        if size <= self.max_size:
+            return
+        for key, digest, file_size in self._db.execute(
+                "SELECT key, digest, size FROM responses ORDER BY used").fetchall():
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            if not self._referenced(digest):
+                self._path(digest).unlink(missing_ok=True)
+                size -= file_size
+            if size <= self.max_size:
+                break
+        self._size = size
+        self._db.commit()
+        logging.debug("Evicted cached responses, cache size %s bytes", size)
+        
+    def close(self):
+        self._db.close()
+
+
+class HarvestState():
+    # Local state file for incremental harvesting. Holds last harvested
+    # datestamp for each (endpoint, set, metadataPrefix) and checkpoints of
+    # an unfinished run.
+    # Number of records between checkpoints
+    interval = 1000
+    
+    def __init__(self, filepath):
+        self._filepath = Path(filepath)
+        self._state = {'marks': {}, 'run': None}
+        if self._filepath.exists():
+            with open(self._filepath, encoding='utf-8') as f:
+                self._state.update(json.load(f))
+                
+    @property
+    def filepath(self):
+        return self._filepath
+        
+    @property
+    def run(self):
+        return self._state['run']
+        
+    def mark(self, key):
+        return self._state['marks'].get(key)
+        
+    def update(self, until, positions, marks):
+        self._state['run'] = {'until': until.isoformat(), 
+                              'sources': dict(positions), 
+                              'marks': dict(marks)}
+        
+    # Run completed, move high-water marks forward
+    def finish(self, marks):
+        for key, datestamp in marks.items():
+            if datestamp > self._state['marks'].get(key, ''):
+                self._state['marks'][key] = datestamp
+        self._state['run'] = None
+        
+    def save(self):
+        logging.debug("Saving harvest state to %s", self._filepath)
+        tmp = self._filepath.with_name(self._filepath.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self._state, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self._filepath)
+        
+    # Records handled by the unfinished run are kept next to the state file,
+    # so that a source restarted from its first page when its checkpoint has
+    # expired does not output them again
+    @property
+    def handled_path(self):
+        return self._filepath.with_name(self._filepath.name + '.seen')
+        
+    def handled(self):
+        if self.run is None:
+            self.handled_path.unlink(missing_ok=True)
+        return SeenSet(self.handled_path)
+
+
+class Metrics():
+    # Counters, gauges (last and peak value) and timing histograms of a run,
+    # written as JSON or as Prometheus textfile (.prom). Components get
+    # NullMetrics when metrics are not collected, it is false so hot paths
+    # check `if self.metrics:` before measuring anything.
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+    prefix = 'oai_harvest_'
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._started = time.monotonic()
+        
+    def __bool__(self):
+        return True
+        
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            
+    def gauge(self, name, value):
+        with self._lock:
+            peak = self.gauges.get(name, (value, value))[1]
+            self.gauges[name] = (value, max(peak, value))
+            
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {'count': 0, 'sum': 0.0, 'max': 0.0, 
+                                                     'buckets': [0] * (len(self.buckets) + 1)}
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+            histogram['buckets'][bisect_left(self.buckets, seconds)] += 1
+            
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+            
+    def to_dict(self):
+        with self._lock:
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                cumulative = list(accumulate(histogram['buckets']))
+                histograms[name] = {'count': histogram['count'], 
+                                    'sum': histogram['sum'], 
+                                    'mean': histogram['sum'] / histogram['count'],
+                                    'max': histogram['max'],
+                                    'buckets': {**{str(le): n for le, n in zip(self.buckets, cumulative)}, 
+                                                '+Inf': cumulative[-1]}}
+            return {'elapsed_seconds': time.monotonic() - self._started,
+                    'counters': dict(self.counters),
+                    'gauges': {name: {'last': last, 'max': peak} for name, (last, peak) in self.gauges.items()},
+                    'histograms': histograms}
+                    
+    def prometheus(self):
+        data = self.to_dict()
+        lines = [f'# TYPE {self.prefix}elapsed_seconds gauge', 
+                 f'{self.prefix}elapsed_seconds {data["elapsed_seconds"]}']
+        for name, value in data['counters'].items():
+            lines += [f'# TYPE {self.prefix}{name}_total counter', f'{self.prefix}{name}_total {value}']
+        for name, gauge in data['gauges'].items():
+            lines += [f'# TYPE {self.prefix}{name} gauge', f'{self.prefix}{name} {gauge["last"]}',
+                      f'# TYPE {self.prefix}{name}_max gauge', f'{self.prefix}{name}_max {gauge["max"]}']
+        for name, histogram in data['histograms'].items():
+            lines.append(f'# TYPE {self.prefix}{name} histogram')
+            lines += [f'{self.prefix}{name}_bucket{{le="{le}"}} {n}' for le, n in histogram['buckets'].items()]
+            lines += [f'{self.prefix}{name}_sum {histogram["sum"]}', f'{self.prefix}{name}_count {histogram["count"]}']
+        return '\n'.join(lines) + '\n'
+        
+    def summary(self):
+        data = self.to_dict()
+        lines = [f'Elapsed {data["elapsed_seconds"]:.2f} s']
+        lines.append(f'{"stage":<28}{"count":>10}{"total s":>12}{"mean ms":>12}{"max ms":>12}')
+        for name, histogram in sorted(data['histograms'].items()):
+            lines.append(f'{name:<28}{histogram["count"]:>10}{histogram["sum"]:>12.2f}'
+                         f'{histogram["mean"] * 1000:>12.2f}{histogram["max"] * 1000:>12.2f}')
+        lines += [f'{name:<28}{value:>10}' for name, value in sorted(data['counters'].items())]
+        lines += [f'{name:<28}{gauge["max"]:>10} (max)' for name, gauge in sorted(data['gauges'].items())]
+        return '\n'.join(lines)
+        
+    # Written atomically, eg. for node exporter's textfile collector
+    def write(self, filepath):
+        filepath = Path(filepath)
+        tmp = filepath.with_name(filepath.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            if filepath.suffix in ('.prom', '.txt'):
+                f.write(self.prometheus())
             else:
-                raise StopIteration
+                json.dump(self.to_dict(), f, indent=1)
+        os.replace(tmp, filepath)
+        
+        
+class NullMetrics(Metrics):
+    # Metrics are not collected
+    def __init__(self):
+        pass
+        
+    def __bool__(self):
+        return False
+        
+    def count(self, name, value=1):
+        pass
+        
+    def gauge(self, name, value):
+        pass
+        
+    def observe(self, name, seconds):
+        pass
+        
+    def timer(self, name):
+        return _null_timer
+        
+        
+_null_timer = nullcontext()
+_null_metrics = NullMetrics()
 
 
+class MetadataIndex():
+    # Local sqlite database of harvested metadata, searched later with new
+    # patterns without harvesting again. Records are inserted in batches and
+    # title, abstract and key words are indexed with FTS5 when sqlite has it.
+    columns = ['identifier', 'datestamp', 'published', 'abstract', 'language', 
+               'publication', 'publisher', 'title', 'key_words', 'urls']
+    
+    def __init__(self, filepath, batch_size=1000):
+        self._filepath = Path(filepath)
+        self.batch_size = batch_size
+        self._rows = []
+        self._db = sqlite3.connect(self._filepath)
+        self._db.execute(f"""CREATE TABLE IF NOT EXISTS records 
+                             ({self.columns[0]} TEXT PRIMARY KEY, {', '.join(self.columns[1:])})""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS records_language ON records (language)")
+        try:
+            self._db.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS records_fts USING fts5 
+                                (title, abstract, key_words, content='records', content_rowid='rowid')""")
+            self.fts = True
+        except sqlite3.OperationalError:
+            logging.warning("SQLite has no FTS5, full-text queries are not available")
+            self.fts = False
+        self._db.commit()
+        
+    @property
+    def filepath(self):
+        return self._filepath
+        
+    def add(self, record):
+        metadata = record.metadata
+        row = {**metadata, 
+               'identifier': record.identifier, 
+               'datestamp': record.datestamp, 
+               'key_words': json.dumps(metadata.get('key_words', []), ensure_ascii=False), 
+               'urls': json.dumps(metadata.get('urls', []), ensure_ascii=False)}
+        self._rows.append(tuple(row.get(column) for column in self.columns))
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+            
+    def flush(self):
+        if not self._rows:
+            return
+        placeholders = ', '.join('?' * len(self.columns))
+        # Latest version of a record added twice in the batch
+        rows = list({row[0]: row for row in self._rows}.values())
+        with self._db:
+            if self.fts:
+                # Old versions of updated records are removed from the full-text index
+                identifiers = [(row[0],) for row in rows]
+                self._db.executemany("""INSERT INTO records_fts (records_fts, rowid, title, abstract, key_words)
+                                        SELECT 'delete', rowid, title, abstract, key_words FROM records 
+                                        WHERE identifier = ?""", identifiers)
+                self._db.executemany("DELETE FROM records WHERE identifier = ?", identifiers)
+            self._db.executemany(f"INSERT OR REPLACE INTO records ({', '.join(self.columns)}) VALUES ({placeholders})", 
+                                 rows)
+            if self.fts:
+                self._db.executemany("""INSERT INTO records_fts (rowid, title, abstract, key_words)
+                                        SELECT rowid, title, abstract, key_words FROM records 
+                                        WHERE identifier = ?""", identifiers)
+        logging.debug("Indexed %s records", len(self._rows))
+        self._rows.clear()
+        
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        
+    # Stored records as Record, language and FTS5 query narrow the rows
+    # read from the database before patterns are matched
+    def records(self, language=None, match=None):
+        self.flush()
+        query = f"SELECT {', '.join(self.columns)} FROM records"
+        conditions, params = [], []
+        if language is not None:
+            conditions.append("language = ?")
+            params.append(language)
+        if match is not None:
+            if not self.fts:
+                raise ValueError("Full-text query needs SQLite with FTS5")
+            conditions.append("rowid IN (SELECT rowid FROM records_fts WHERE records_fts MATCH ?)")
+            params.append(match)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        for row in self._db.execute(query + " ORDER BY rowid", params):
+            metadata = {column: value for column, value in zip(self.columns[2:], row[2:]) if value is not None}
+            metadata['key_words'] = json.loads(metadata.get('key_words', '[]'))
+            metadata['urls'] = json.loads(metadata.get('urls', '[]'))
+            yield Record.from_metadata(row[0], row[1], metadata)
+            
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+class SearchPatterns():
+    # Named regexes tested in a single pass over each record. Unnamed
+    # pattern (plain -sp regex) is stored with name None.
+    _backref = re.compile(r"\\[1-9]|\(\?P=")
+    
+    def __init__(self, patterns=None):
+        self.patterns = dict(patterns or {})
+        self._compiled = [(name, re.compile(pattern)) for name, pattern in self.patterns.items()]
+        self._combined = self._combine()
+        
+    # Alternation of all patterns for quick rejection of entries matching nothing.
+    # Numbered backreferences would point to wrong groups once combined, global
+    # inline flags and repeated group names do not compile in the alternation.
+    # Without the alternation each pattern is matched on its own.
+    def _combine(self):
+        if len(self._compiled) < 2:
+            return None
+        if any(self._backref.search(pattern) for pattern in self.patterns.values()):
+            return None
+        try:
+            return re.compile("|".join(f"(?:{pattern})" for pattern in self.patterns.values()))
+        except re.error:
+            return None
+    
+    @classmethod
+    def from_args(cls, searchpatterns=None, patternfile=None):
+        patterns = {}
+        for line in cls._read_patternfile(patternfile):
+            name, pattern = cls.parse(line)
+            patterns[name] = pattern
+        for arg in searchpatterns or []:
+            name, pattern = cls.parse(arg)
+            patterns[name] = pattern
+        if None in patterns and len(patterns) > 1:
+            raise ValueError("Give names for all search patterns (name=regex) when using more than one")
+        return cls(patterns)
+    
+    @staticmethod
+    def _read_patternfile(patternfile):
+        if patternfile is None:
+            return []
+        with open(patternfile, encoding='utf-8') as f:
+            lines = [line.strip() for line in f]
+        return [line for line in lines if line and not line.startswith('#')]
+    
+    # "name=regex" when name is an identifier, otherwise the whole value is a
+    # plain regex. A plain regex like x=y is written x[=]y.
+    @classmethod
+    def parse(cls, value):
+        name, sep, pattern = value.partition("=")
+        if sep and pattern and name.isidentifier():
+            logging.info("Search pattern %s: %s", name, pattern)
+            return name, pattern
+        return None, value
+        
+    @property
+    def names(self):
+        return list(self.patterns.keys()) or [None]
+        
+    def __getitem__(self, name):
+        return self.patterns.get(name)
+        
+    def __len__(self):
+        return len(self.patterns)
+    
+    # Names of the patterns matching any of the entries
+    def match(self, entries):
+        if not self._compiled:
+            return [None]
+        matched = set()
+        for entry in entries:
+            if self._combined is not None and not self._combined.search(entry):
+                continue
+            for name, pattern in self._compiled:
+                if name not in matched and pattern.search(entry):
+                    matched.add(name)
+            if len(matched) == len(self._compiled):
+                break
+        return [name for name, _ in self._compiled if name in matched]
+        
+
 class Record():
+    # kk metadata fields as (element, qualifier): metadata key
+    fields = {("title", None): "title",
+              ("description", "abstract"): "abstract",
+              ("relation", "ispartofseries"): "publication",
+              ("publisher", None): "publisher",
+              ("language", "iso"): "language",
+              ("date", "issued"): "published"}
+    __slots__ = ('counter', 'matches', 'accepted', 'identifier', 'datestamp', '_xml', '_metadata')
     _matches = count(0)
     _counter = count(0)
+    
+    # response is a <record> element of ListRecords response or sickle's
+    # Record. Metadata is parsed when first needed and XML released after that.
     def __init__(self, response):
         self.counter = next(self._counter)
-        self.metadata = {}
+        self.matches = []
+        self.accepted = None
+        self._metadata = None
         
-        self.xml = response.xml
-        self._parse_metadata()
+        self._xml = getattr(response, 'xml', response)
+        self.identifier, self.datestamp = self._parse_header(self._xml)
         
-    def _parse_metadata(self):
+    @staticmethod
+    def _parse_header(xml):
+        header = xml.find(OAI_HEADER)
+        if header is None:
+            return None, None
+        return header.findtext(OAI_IDENTIFIER), header.findtext(OAI_DATESTAMP)
+        
+    @property
+    def metadata(self):
+        if self._metadata is None and self._xml is not None:
+            self._parse_metadata(self._xml)
+            self._xml = None
+        return self._metadata
+        
+    # Single pass over kk fields and files
+    def _parse_metadata(self, xml):
         meta = {}
         key_words = []
         urls = []
-        for field in self.xml.findall(".//{http://kk/1.0}field"):
-            elem = field.get("element")
-            qualif = field.get("qualifier")
-            value = field.get("value")
-            
-            match (elem, qualif):
-                case ("title", None):
-                    #self.title = value
-                    meta["title"] = value
-                case ("description", "abstract"):
-                    #self.abstract = value
-                    meta["abstract"] = value
-                case ("relation", "ispartofseries"):
-                    #self.publication = value
-                    meta["publication"] = value
-                case ("publisher", None):
-                    #self.publisher = value
-                    meta["publisher"] = value
-                case ("subject", None):
-                    #self.key_words.append(value)
-                    key_words.append(value)
-                case ("language", "iso"):
-                    #self.language = value
-                    meta["language"] = value
-                case ("date", "issued"):
-                    #self.published = value
-                    meta["published"] = value
-        
-        for file in self.xml.findall(".//{http://kk/1.0}file"):
-            type = file.get("type")
-            href = file.get("href")
-            if type=="application/pdf":
-                    urls.append(href)
-        
-        self.metadata = {**meta, "key_words": key_words, "urls": urls}
-        logging.debug(self.metadata)
+        for elem in xml.iter(KK_FIELD, KK_FILE):
+            attrib = elem.attrib
+            if elem.tag == KK_FIELD:
+                key = (attrib.get("element"), attrib.get("qualifier"))
+                if key == ("subject", None):
+                    key_words.append(attrib.get("value"))
+                elif key in self.fields:
+                    meta[self.fields[key]] = attrib.get("value")
+            elif attrib.get("type") == "application/pdf":
+                urls.append(attrib.get("href"))
+        
+        self._metadata = {**meta, "key_words": key_words, "urls": urls}
+        logging.debug(self._metadata)
+        
+    # Single kk field without parsing the whole record, last value as in metadata
+    def _field(self, key, xpath):
+        if self._metadata is not None:
+            return self._metadata.get(key)
+        values = xpath(self._xml)
+        return str(values[-1]) if values else None
+        
+    @property
+    def language(self):
+        return self._field("language", _kk_xpath("language", "iso"))
+        
+    @property
+    def title(self):
+        return self._field("title", _kk_xpath("title"))
+        
+    # Record of metadata stored earlier, eg. in MetadataIndex, or parsed and
+    # filtered already in a parse worker (accepted is the result of the filter)
+    @classmethod
+    def from_metadata(cls, identifier, datestamp, metadata, matches=None, accepted=None):
+        record = cls.__new__(cls)
+        record.counter = next(cls._counter)
+        record.matches = matches or []
+        record.accepted = accepted
+        record.identifier = identifier
+        record.datestamp = datestamp
+        record._xml = None
+        record._metadata = metadata
+        return record
+        
+    # Texts searched by patterns: title is looked up first and the rest of
+    # metadata parsed only if title did not settle the match
+    def entries(self):
+        title = self.title
+        if title is not None:
+            yield title
+        abstract = self.metadata.get("abstract")
+        if abstract is not None:
+            yield abstract
+        yield from self.metadata["key_words"]
     
     def __repr__(self):
-        return f'Record({response})'
+        return f'Record({self.identifier})'
     
     def __str__(self):
-        return self.metadata
-       
-    # Search in multiple places
-    def _match(self, pattern):    
-        entries = [i for i in [self.metadata.get("title"), 
-                               self.metadata.get("abstract"), 
-                               *self.metadata.get("key_words")]
-                   if i is not None
-                  ]
-        if not pattern:
-            return True
-        else:
-            matches = [re.search(pattern, entry) for entry in entries]
-            return any(matches)
-            
-        
-    def _check_language(self, language):
-        if not language:
-            return True
-        else:
-            return self.metadata.get("language") == language
-            
+        return str(self.metadata)
         
+    # pattern can be a single regex or SearchPatterns, matching pattern names
+    # are stored to self.matches
     def filter(self, language, pattern):
+        return RecordFilter(language, pattern)(self)
+
+
+# Values of a kk field, XPath is compiled when first needed
+@cache
+def _kk_xpath(element, qualifier=None):
+    condition = f'[@qualifier="{qualifier}"]' if qualifier else '[not(@qualifier)]'
+    return etree.XPath(f'.//kk:field[@element="{element}"]{condition}/@value', namespaces={'kk': 'http://kk/1.0'})
+    
+    
+class RecordFilter():
+    # Predicate for records by language and search patterns. Cheap checks run
+    # first and stop at the first failure: language, then title, abstract and
+    # key words until all patterns have matched. Only records that pass need
+    # their full metadata parsed.
+    def __init__(self, language=None, patterns=None, metrics=None):
+        self.language = language
+        if not isinstance(patterns, SearchPatterns):
+            patterns = SearchPatterns({None: patterns} if patterns else None)
+        self.patterns = patterns
+        self.metrics = metrics if metrics is not None else _null_metrics
+        self.matched = 0
+        
+    def __call__(self, record):
+        if not self.metrics:
+            return self._filter(record)
+        start = time.perf_counter()
+        matched = self._filter(record)
+        self.metrics.observe('filter_seconds', time.perf_counter() - start)
+        self.metrics.count('records_matched' if matched else 'records_rejected')
+        return matched
+        
+    def _filter(self, record):
+        # Filtered in a parse worker already
+        if record.accepted is not None:
+            self.matched += record.accepted
+            return record.accepted
         #logging.info("Checking record: %s", self.title)
-        if self._check_language(language) and self._match(pattern):
-            next(self._matches)
+        record.matches = []
+        if self.language and record.language != self.language:
+            return False
+        record.matches = self.patterns.match(record.entries())
+        if record.matches:
+            next(Record._matches)
+            self.matched += 1
             #logging.info("Record no. %s: %s", self.counter, self.metadata.get("title"))
-            logging.info(f'[{self.counter}] {self.metadata.get("title")}')
+            logging.info('[%s] %s', record.counter, record.metadata.get("title"))
             return True
         else:
             #logging.debug("Skip record no. %s: %s", self.counter, self.metadata.get("title"))
@@ -185,13 +1765,68 @@ class Record():
             return False
 
 
+class TokenBucket():
+    # Rate limit: on average rate acquisitions per second, bursts up to burst
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
 class Downloader():
+    # Status codes worth retrying, other HTTP errors fail at once
+    retry_status = {429, 500, 502, 503, 504}
+    backoff = 2
+    backoff_max = 120
+    manifest_name = '.manifest.jsonl'
     
-    def __init__(self, outdir):
-        self._outdir = outdir
+    # Files are downloaded by concurrency threads sharing one pooled session,
+    # rate limits requests per second to each host. Downloads are written to
+    # temporary files which are resumed with Range requests after a failure.
+    # With store files are kept once by their sha256 in the store directory
+    # and hard linked to outdir, urls found in the store are not downloaded again.
+    # ETag, Last-Modified and size of each file are kept in a manifest, with
+    # resync files are revalidated with conditional requests and downloaded
+    # again only when they have changed.
+    def __init__(self, outdir, concurrency=4, rate=None, retries=3, store=None, metrics=None, resync=False):
+        self.outdir = outdir
+        self.resync = resync
+        self.metrics = metrics if metrics is not None else _null_metrics
+        self._store = Path(store) if store is not None else None
+        self._index = self._read_index()
         self._urls = []
         self._download_attempt = 0
         self._download_success = 0
+        self._download_unchanged = 0
+        self.concurrency = concurrency
+        self.rate = rate
+        self.retries = retries
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._url_locks = {}
+        self._files = {}
+        self._manifests = {}
+        self._checked = set()
+        self._queue = None
+        self._threads = []
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
         
     @property
     def outdir(self):
@@ -205,6 +1840,16 @@ class Downloader():
         else:
             self._outdir = Path('.')
     
+    @property
+    def store(self):
+        return self._store
+        
+    @property
+    def _partdir(self):
+        if self._store is not None:
+            return self._store / 'tmp'
+        return self._outdir / '.partial'
+    
     @property
     def url(self):
         return self._urls
@@ -213,7 +1858,6 @@ class Downloader():
     def url(self, value):
         #logging.info("Appending %s to downloader", value)
         self._urls.append(value)
-        self._download_attempt += 1
         #logging.info("Downloader has %s urls", len(self._urls))
         #if len(self._urls) == 1000:
         #    logging.info("Stored urls reached %s", len(self._urls))
@@ -224,8 +1868,40 @@ class Downloader():
     def url(self):
         #logging.info("Deleting %s urls from downloader", str(len(self._urls)))
         self._urls.clear()
+        
+    # Wait for turn to request the host
+    def _throttle(self, url):
+        if not self.rate:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate)
+            bucket = self._buckets[host]
+        bucket.acquire()
+        
+    # Exponential backoff with jitter, Retry-After of the server is respected
+    def _delay(self, attempt, response=None):
+        delay = min(self.backoff_max, self.backoff * 2 ** (attempt - 1))
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(self.backoff_max, int(retry_after)))
+        return delay * random.uniform(0.5, 1.5)
+        
+    @staticmethod
+    def _filename(url, response):
+        if "content-disposition" in response.headers:
+            content_disposition = response.headers["content-disposition"]
+            filename = content_disposition.split("filename=")[1]
+        else:
+            filename = url.split("/")[-1]
+            
+        filename_valid = "".join(x for x in filename if x.isalnum())
+        filename_valid = filename_valid[:-3] + '.' + filename[-3:]
+        logging.info(f'Converted {filename} to {filename_valid}')
+        return filename_valid
     
-    def download_file(self, url):
+    def download_file(self, url, outdir=None):
         # First version workaround
         #try:
         #    response = requests.get(url, allow_redirects=True)
@@ -246,53 +1922,595 @@ class Downloader():
         #    self._download_success += 1
         #    logging.info('Downloaded file: %s', filename)
         
-        # Second version
-        for attempt in range(1,3):
-            logging.info(f'Trying to download {url}')
-            try:
-                if attempt > 1:
-                    time.sleep(10)
-                with requests.get(url, stream=True) as response:
-                    response.raise_for_status()
-                    
-                    if "content-disposition" in response.headers:
-                        content_disposition = response.headers["content-disposition"]
-                        filename = content_disposition.split("filename=")[1]
-                    else:
-                        filename = url.split("/")[-1]
-                        
-                    filename_valid = "".join(x for x in filename if x.isalnum())
-                    filename_valid = filename_valid[:-3] + '.' + filename[-3:]
-                    logging.info(f'Converted {filename} to {filename_valid}')
-                        
-                    out_file = self._outdir / Path(filename_valid)
-                    if out_file.exists(): 
-                        logging.info(f'File exists: {out_file}. Skip.')
-                        return None
-                        
-                    with open(out_file, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=1024*1024):
-                            f.write(chunk)
-                            
-                    logging.info(f'Downloaded {filename_valid}')
-                    return None
-                    
-            except Exception as ex:
-                logging.warning(f'Attempt #{attempt} failed with error: {ex}')
+        # Second version
+        outdir = Path(outdir) if outdir is not None else self._outdir
+        with self._lock:
+            self._download_attempt += 1
+            url_lock = self._url_locks.setdefault(url, threading.Lock())
+        # Same url for several outdirs is downloaded one at a time, the
+        # temporary file is shared and later ones are linked from the store
+        with url_lock, self.metrics.timer('download_seconds'):
+            self._download_locked(url, outdir)
+        return self._files.get((url, outdir))
+            
+    def _download_locked(self, url, outdir):
+        # With resync the first request of a url in a run revalidates it
+        if (not self.resync or url in self._checked) and self._link_stored(url, outdir):
+            with self._lock:
+                self._download_success += 1
+            self.metrics.count('downloads_linked')
+            return None
+        for attempt in range(1, self.retries + 2):
+            logging.info(f'Trying to download {url}')
+            self._throttle(url)
+            response = None
+            try:
+                if self._download(url, outdir):
+                    with self._lock:
+                        self._download_success += 1
+                    self.metrics.count('downloads')
+                else:
+                    self.metrics.count('downloads_skipped')
+                return None
+                    
+            except Exception as ex:
+                logging.warning(f'Attempt #{attempt} failed with error: {ex}')
+                response = getattr(ex, 'response', None)
+                status = getattr(response, 'status_code', None)
+                if isinstance(ex, requests.HTTPError) and status not in self.retry_status:
+                    break
+                if attempt <= self.retries:
+                    self.metrics.count('download_retries')
+                    time.sleep(self._delay(attempt, response))
+        logging.error(f'Failed to download {url}')
+        self.metrics.count('downloads_failed')
+        
+    # Download to a temporary file, continuing earlier partial download when
+    # the file has not changed. False if the file exists already. Files in
+    # the manifest are skipped without a request, with resync they are
+    # revalidated with a conditional request and downloaded only if changed.
+    def _download(self, url, outdir):
+        entry = self._manifest(outdir).get(url)
+        if entry is not None and not self._local(entry, outdir).exists():
+            entry = None
+        if entry is not None and not self.resync:
+            logging.info(f'File exists: {entry["filename"]}. Skip.')
+            self._files[(url, outdir)] = outdir / entry['filename']
+            return False
+            
+        self._partdir.mkdir(parents=True, exist_ok=True)
+        part = self._partdir / (hashlib.sha1(url.encode('utf-8')).hexdigest() + '.part')
+        validators = part.with_suffix('.json')
+        offset = part.stat().st_size if part.exists() else 0
+        headers = {}
+        if offset and validators.exists():
+            validator = json.loads(validators.read_text(encoding='utf-8'))
+            if validator.get('etag') or validator.get('last_modified'):
+                headers = {'Range': f'bytes={offset}-', 
+                           'If-Range': validator.get('etag') or validator['last_modified']}
+        elif entry is not None:
+            headers = self._conditional(entry)
+                           
+        with self._session.get(url, stream=True, timeout=60, headers=headers) as response:
+            if entry is not None and (response.status_code == 304 or self._unchanged(entry, response)):
+                return self._not_modified(url, outdir, entry)
+            response.raise_for_status()
+            
+            out_file = outdir / Path(self._filename(url, response))
+            if out_file.exists() and entry is None: 
+                if self.resync and self._adopt(url, out_file, response):
+                    return False
+                if not self.resync:
+                    logging.info(f'File exists: {out_file}. Skip.')
+                    self._files[(url, outdir)] = out_file
+                    return False
+                
+            if response.status_code == 206:
+                if not response.headers.get('content-range', '').startswith(f'bytes {offset}-'):
+                    part.unlink()
+                    raise ValueError(f'Unexpected content range {response.headers.get("content-range")}')
+                logging.info(f'Resuming download of {out_file.name} from {offset} bytes')
+            else:
+                offset = 0
+            entry = {'url': url,
+                     'filename': out_file.name,
+                     'etag': response.headers.get('etag'),
+                     'last_modified': response.headers.get('last-modified')}
+            validators.write_text(json.dumps(entry), encoding='utf-8')
+                
+            with open(part, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1024*1024):
+                    f.write(chunk)
+                self.metrics.count('download_bytes', f.tell() - offset)
+                    
+        self._finish(part, out_file, entry)
+        validators.unlink(missing_ok=True)
+        self._files[(url, outdir)] = out_file
+        with self._lock:
+            self._checked.add(url)
+        logging.info(f'Downloaded {out_file.name}')
+        return True
+        
+    @staticmethod
+    def _conditional(entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+        
+    # Full response of a server ignoring conditional requests, same validators
+    # (or the same size when there are none) mean the file has not changed
+    @staticmethod
+    def _unchanged(entry, response):
+        if response.status_code != 200:
+            return False
+        etag = response.headers.get('etag')
+        if entry.get('etag') or etag:
+            return etag == entry.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if entry.get('last_modified') or last_modified:
+            return last_modified == entry.get('last_modified')
+        return response.headers.get('content-length') == str(entry.get('size'))
+        
+    def _not_modified(self, url, outdir, entry):
+        logging.info(f'{entry["filename"]} has not changed')
+        self.metrics.count('downloads_not_modified')
+        with self._lock:
+            self._checked.add(url)
+            self._download_unchanged += 1
+        if self._store is not None:
+            self._link(self._stored_path(entry), outdir / entry['filename'], replace=True)
+        self._files[(url, outdir)] = outdir / entry['filename']
+        return False
+        
+    # File downloaded before the manifest was kept: validators of the response
+    # are taken as its own when the size matches, the body is not read
+    def _adopt(self, url, out_file, response):
+        if self._store is not None or response.headers.get('content-length') != str(out_file.stat().st_size):
+            return False
+        logging.info(f'Adding existing {out_file} to manifest')
+        self._add_index({'url': url,
+                         'filename': out_file.name,
+                         'etag': response.headers.get('etag'),
+                         'last_modified': response.headers.get('last-modified'),
+                         'size': out_file.stat().st_size}, out_file.parent)
+        self._files[(url, out_file.parent)] = out_file
+        with self._lock:
+            self._checked.add(url)
+            self._download_unchanged += 1
+        return True
+        
+    # Move complete download to its place, into the store when used
+    def _finish(self, part, out_file, entry):
+        if self._store is None:
+            entry['size'] = part.stat().st_size
+            os.replace(part, out_file)
+            self._add_index(entry, out_file.parent)
+            return
+        digest = hashlib.sha256()
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                digest.update(chunk)
+        entry.update({'sha256': digest.hexdigest(), 'size': part.stat().st_size})
+        stored = self._stored_path(entry)
+        stored.parent.mkdir(parents=True, exist_ok=True)
+        if stored.exists():
+            logging.info(f'{out_file.name} is already in store as {stored.name}')
+            part.unlink()
+        else:
+            os.replace(part, stored)
+        self._link(stored, out_file, replace=True)
+        self._add_index(entry)
+        
+    def _stored_path(self, entry):
+        return self._store / 'objects' / entry['sha256'][:2] / (entry['sha256'] + Path(entry['filename']).suffix)
+        
+    # Local copy of a manifest entry
+    def _local(self, entry, outdir):
+        if self._store is not None:
+            return self._stored_path(entry)
+        return outdir / entry['filename']
+        
+    # Hard link to the stored file, copy if linking is not possible. An
+    # existing file is replaced with replace when it is not the stored one.
+    @staticmethod
+    def _link(stored, out_file, replace=False):
+        if out_file.exists():
+            if not replace or out_file.samefile(stored):
+                return
+            out_file.unlink()
+        try:
+            os.link(stored, out_file)
+        except OSError:
+            shutil.copy2(stored, out_file)
+            
+    # Url downloaded earlier to the store
+    def _link_stored(self, url, outdir):
+        entry = self._index.get(url)
+        if entry is None or not self._stored_path(entry).exists():
+            return False
+        logging.info(f'Linking {entry["filename"]} from store')
+        self._link(self._stored_path(entry), outdir / entry['filename'], replace=self.resync)
+        self._files[(url, outdir)] = outdir / entry['filename']
+        return True
+        
+    # Manifest of downloaded files with their validators and size: index of
+    # the store, or .manifest.jsonl of outdir without store
+    def _manifest_path(self, outdir=None):
+        if self._store is not None:
+            return self._store / 'index.jsonl'
+        return Path(outdir) / self.manifest_name
+        
+    def _manifest(self, outdir=None):
+        if self._store is not None:
+            return self._index
+        path = self._manifest_path(outdir)
+        with self._lock:
+            if path not in self._manifests:
+                self._manifests[path] = self._read_index(path)
+            return self._manifests[path]
+        
+    # One json entry per line, latest entry of url is valid
+    def _read_index(self, path=None):
+        index = {}
+        path = path or (self._store / 'index.jsonl' if self._store is not None else None)
+        if path is None or not path.exists():
+            return index
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    index[entry['url']] = entry
+        return index
+        
+    def _add_index(self, entry, outdir=None):
+        manifest = self._manifest(outdir)
+        with self._lock:
+            manifest[entry['url']] = entry
+            with open(self._manifest_path(outdir), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                
+    # Urls of the manifest, eg. to revalidate all of them
+    def manifest_urls(self, outdir=None):
+        return list(self._manifest(outdir or self._outdir))
+        
+    def threaded_download(self):
+        logging.info("Starting threaded download with %s files", len(self._urls))
+        self._outdir.mkdir(parents=True, exist_ok=True)
+        with futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for _ in executor.map(self.download_file, self._urls):
+                pass
+        logging.info("Finished threaded download")
+        logging.info('Currently %s attempted downloads and %s succesfully downloaded', self._download_attempt, self._download_success)
+        
+    # Pipeline mode, urls submitted while harvesting are downloaded by worker
+    # threads at once. The queue holds at most queue_size urls, submit blocks
+    # when it is full so the harvest waits for slow downloads.
+    def start(self, queue_size=None):
+        self._queue = Queue(maxsize=queue_size or self.concurrency * 4)
+        self._submitted = set()
+        self._threads = [threading.Thread(target=self._consume, daemon=True) for _ in range(self.concurrency)]
+        for thread in self._threads:
+            thread.start()
+        logging.info("Started %s download workers", self.concurrency)
+        
+    # Callback is called with the path of the file when it has been
+    # downloaded (or found), eg. to extract its text
+    def submit(self, url, outdir=None, callback=None):
+        outdir = Path(outdir) if outdir is not None else self._outdir
+        if (url, outdir) in self._submitted:
+            return
+        self._submitted.add((url, outdir))
+        outdir.mkdir(parents=True, exist_ok=True)
+        self._queue.put((url, outdir, callback))
+        if self.metrics:
+            self.metrics.gauge('download_queue', self._queue.qsize())
+        
+    def _consume(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _DONE:
+                    return
+                url, outdir, callback = item
+                path = self.download_file(url, outdir)
+                if path is not None and callback is not None:
+                    callback(path)
+            except Exception as ex:
+                logging.error(f'Download of {item[0]} failed: {ex}')
+            finally:
+                self._queue.task_done()
+                
+    # Wait until the submitted downloads are done, eg. before a checkpoint
+    # moves past the records they belong to. Workers keep running.
+    def flush(self):
+        if self._queue is not None:
+            self._queue.join()
+            
+    # Wait for the submitted downloads and stop the workers
+    def join(self):
+        if self._queue is None:
+            return
+        for _ in self._threads:
+            self._queue.put(_DONE)
+        for thread in self._threads:
+            thread.join()
+        self._queue = None
+        self._threads = []
+        logging.info('Finished downloads, %s attempted and %s succesfully downloaded', self._download_attempt, self._download_success)
+
+
+# First installed pdf library, imported by the extraction workers
+def _pdf_backend():
+    for name in ('fitz', 'pypdf', 'pdfminer'):
+        if importlib.util.find_spec(name) is not None:
+            return name
+    raise ImportError("Text extraction needs PyMuPDF, pypdf or pdfminer.six, install with: pip install webscraper[pdf]")
+
+
+def _pdf_pages(path, backend):
+    if backend == 'fitz':
+        import fitz
+        with fitz.open(path) as document:
+            return [page.get_text() for page in document]
+    if backend == 'pypdf':
+        import pypdf
+        return [page.extract_text() or '' for page in pypdf.PdfReader(path).pages]
+    from pdfminer.high_level import extract_text
+    pages = extract_text(path).split('\f')
+    return pages[:-1] if pages and not pages[-1] else pages
+
+
+# Text of a pdf file in a worker process as (sha256, text, pages), text is
+# None when the file has not changed since previous extraction. Pages are
+# separated by form feeds.
+def _extract_pdf(path, previous, backend):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            digest.update(chunk)
+    if digest.hexdigest() == previous:
+        return previous, None, 0
+    pages = _pdf_pages(path, backend)
+    return digest.hexdigest(), '\f'.join(pages), len(pages)
+
+
+class TextExtractor():
+    # Text of downloaded pdf files extracted in worker processes with the
+    # first installed of PyMuPDF, pypdf and pdfminer.six. With output ending
+    # .jsonl each file is a line with identifier, file name, sha256, metadata
+    # and text, otherwise output is a directory of .txt files and the same
+    # lines without text are written to manifest.jsonl. Files are keyed by
+    # record identifier and file name (or path of files without a record), a
+    # file is skipped when its sha256 is the same as in the last extraction.
+    def __init__(self, output, workers=None, metrics=None):
+        self.backend = _pdf_backend()
+        self._output = Path(output)
+        self.workers = workers or os.cpu_count()
+        self.metrics = metrics if metrics is not None else _null_metrics
+        self._hashes = self._read_manifest()
+        self._submitted = set()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.workers * 2)
+        self._executor = None
+        self.extracted = 0
+        self.skipped = 0
+        self.failed = 0
+
+    @property
+    def output(self):
+        return self._output
+
+    @property
+    def jsonl(self):
+        return self._output.suffix == '.jsonl'
+
+    @property
+    def manifest(self):
+        return self._output if self.jsonl else self._output / 'manifest.jsonl'
+
+    @staticmethod
+    def _file(identifier, path):
+        return Path(path).name if identifier else str(path)
+        
+    @staticmethod
+    def _key(identifier, file):
+        return f"{identifier or ''}|{file}"
+
+    # sha256 of each extracted file, latest line of a key is valid
+    def _read_manifest(self):
+        hashes = {}
+        if not self.manifest.exists():
+            return hashes
+        with open(self.manifest, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    hashes[self._key(entry['identifier'], entry['file'])] = entry['sha256']
+        logging.info("Loaded %s extracted files from %s", len(hashes), self.manifest)
+        return hashes
+
+    def start(self):
+        self.manifest.parent.mkdir(parents=True, exist_ok=True)
+        self._executor = futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=_mp_context())
+        logging.info("Started %s text extraction workers with %s", self.workers, self.backend)
+        return self
+        
+    # A worker which died (eg. killed for its memory use) breaks the whole
+    # pool, the broken pool is replaced with a new one
+    def _restart(self, broken):
+        with self._lock:
+            if self._executor is not broken:
+                return
+            logging.warning("Text extraction worker died, restarting workers")
+            self.metrics.count('extract_restarts')
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=_mp_context())
+
+    # Extract text of a file, blocks while 2 * workers files are waiting
+    def submit(self, path, identifier=None, metadata=None):
+        key = self._key(identifier, self._file(identifier, path))
+        with self._lock:
+            if key in self._submitted:
+                return
+            self._submitted.add(key)
+            previous = self._hashes.get(key)
+        self._slots.acquire()
+        try:
+            executor = self._executor
+            try:
+                future = executor.submit(_extract_pdf, str(path), previous, self.backend)
+            except futures.BrokenExecutor:
+                self._restart(executor)
+                executor = self._executor
+                future = executor.submit(_extract_pdf, str(path), previous, self.backend)
+        except Exception:
+            self._slots.release()
+            with self._lock:
+                self._submitted.discard(key)
+            raise
+        future.add_done_callback(lambda future: self._done(future, executor, key, path, identifier, metadata))
+
+    # Files lost with a broken pool can be submitted again
+    def _done(self, future, executor, key, path, identifier, metadata):
+        try:
+            sha256, text, pages = future.result()
+        except Exception as ex:
+            logging.warning(f'Text extraction of {path} failed: {ex!r}')
+            self.failed += 1
+            self.metrics.count('extract_failed')
+            if isinstance(ex, futures.BrokenExecutor):
+                with self._lock:
+                    self._submitted.discard(key)
+                self._restart(executor)
+            return
+        finally:
+            self._slots.release()
+        if text is None:
+            logging.debug("Text of %s is up to date", path)
+            self.skipped += 1
+            self.metrics.count('extract_skipped')
+            return
+        entry = {'identifier': identifier, 'file': self._file(identifier, path), 'sha256': sha256, 'pages': pages}
+        if metadata:
+            entry['metadata'] = metadata
+        with self._lock:
+            if self.jsonl:
+                entry['text'] = text
+            else:
+                text_file = self._text_path(identifier, entry['file'])
+                text_file.write_text(text, encoding='utf-8')
+                entry['text_file'] = text_file.name
+            with open(self.manifest, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+            self._hashes[self._key(identifier, entry['file'])] = sha256
+            self.extracted += 1
+        self.metrics.count('extracted')
+        self.metrics.count('extracted_pages', pages)
+
+    def _text_path(self, identifier, file):
+        name = f"{identifier}_{Path(file).stem}" if identifier else str(Path(file).with_suffix(''))
+        return self._output / (re.sub(r'[^\w.-]+', '_', name).strip('_') + '.txt')
+
+    # Wait for submitted files and stop the workers
+    def join(self):
+        if self._executor is None:
+            return
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        logging.info('Finished text extraction, %s extracted, %s unchanged and %s failed',
+                     self.extracted, self.skipped, self.failed)
+
+
+class StreamWriter():
+    # Buffered rows are appended to a temporary .part file in batches and the
+    # file is renamed to filepath when closed, so memory use stays flat and a
+    # half written file is never left with the final name.
+    def __init__(self, filepath, batch_size=1000):
+        self._filepath = filepath
+        self._rows = []
+        self.batch_size = batch_size
+        self._file = None
+        
+    @property
+    def filepath(self):
+        return self._filepath
+        
+    @property
+    def partpath(self):
+        return Path(str(self._filepath) + '.part')
+        
+    # Append continues .part file (or the file itself) left by an interrupted run
+    def open(self, append=False):
+        if self._filepath is None or self._file is not None:
+            return
+        if append and not self.partpath.exists() and Path(self._filepath).exists():
+            os.replace(self._filepath, self.partpath)
+        append = append and self.partpath.exists() and self.partpath.stat().st_size > 0
+        logging.info("Writing to file: %s", str(self.partpath))
+        self._file = open(self.partpath, "a" if append else "w", newline="", encoding='utf-8')
+        if not append:
+            self._write_header(self._file)
+            
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+            
+    def flush(self):
+        if self._filepath is None:
+            self._rows.clear()
+            return
+        if self._file is None:
+            self.open()
+        self._write_rows(self._file, self._rows)
+        self._file.flush()
+        self._rows.clear()
         
-    def threaded_download(self):
-        logging.info("Starting threaded download with %s files", len(self._urls))
-        #with ThreadPoolExecutor() as executor:
-        #    executor.map(self.download_file, self._urls)
-        for i in self._urls:
-            self.download_file(i)
-        logging.info("Finished threaded download")
-        logging.info('Currently %s attempted downloads and %s succesfully downloaded', self._download_attempt, self._download_success)
-    
-class MetadataWriter():
-        def __init__(self, filepath):
-            self._filepath = filepath
-            self._metadata = []
+    def close(self):
+        if self._filepath is None:
+            return
+        self.flush()
+        self._file.close()
+        self._file = None
+        if Path(self._filepath).exists():
+            logging.warning("Overwriting old file %s", self._filepath)
+        os.replace(self.partpath, self._filepath)
+        
+    def _write_header(self, f):
+        pass
+        
+    def _write_rows(self, f, rows):
+        raise NotImplementedError
+        
+        
+class FilelistWriter(StreamWriter):
+    # File urls, one per line
+    @property
+    def url(self):
+        return self._rows
+        
+    @url.setter
+    def url(self, value):
+        self.write(value)
+        
+    def _write_rows(self, f, rows):
+        f.writelines((str(i)+'\n' for i in rows))
+        
+        
+class MetadataWriter(StreamWriter):
+        fieldnames = ['published', 'abstract', 'language', 
+                      'publication', 'publisher', 'title', 
+                      'key_words', 'urls', 'search_term']
+        
+        # By default metadata is collected to memory and written with write_csv,
+        # with stream rows are written in batches while harvesting (see StreamWriter)
+        def __init__(self, filepath, stream=False, batch_size=1000):
+            super().__init__(filepath, batch_size)
+            self._metadata = self._rows
+            self.stream = stream
             
         @property
         def filepath(self):
@@ -311,30 +2529,352 @@ class MetadataWriter():
         
         @metadata.setter
         def metadata(self, value):
-            self._metadata.append(value)
+            if self.stream:
+                self.write(value)
+            else:
+                self._metadata.append(value)
             
         @metadata.deleter
         def metadata(self):
-            logging.debug("Clearing metadata list length of %(len)s", len(self.metadata))
+            logging.debug("Clearing metadata list length of %s", len(self.metadata))
             self._metadata.clear()
             
+        def _writer(self, f):
+            return csv.DictWriter(f, 
+                                  #fieldnames=self.metadata[0].keys(),
+                                  fieldnames=self.fieldnames,
+                                  extrasaction='ignore', delimiter=';')
+            
+        def _write_header(self, f):
+            self._writer(f).writeheader()
+            
+        def _write_rows(self, f, rows):
+            self._writer(f).writerows(rows)
+            
         def write_csv(self):
             if self.filepath is not None:
                 logging.info("Writing metadata to file: %s", str(self._filepath))
                 if Path(self.filepath).exists():
                     logging.warning("Overwriting old metadata file")
                 with open(self.filepath, "w", newline="", encoding='utf-8') as f:
-                    w = csv.DictWriter(f, 
-                                       #fieldnames=self.metadata[0].keys(),
-                                       fieldnames=['published', 'abstract', 'language', 
-                                                   'publication', 'publisher', 'title', 
-                                                   'key_words', 'urls', 'search_term'],
-                                       extrasaction='ignore', delimiter=';')
-                    w.writeheader()
-                    w.writerows(self.metadata)
+                    self._write_header(f)
+                    self._write_rows(f, self.metadata)
+            
+        
+
+class ParquetWriter(MetadataWriter):
+    # Metadata to Parquet (.parquet) or Arrow IPC (.arrow, .feather) file with
+    # typed columns: key words and urls as lists and published as a date. Each
+    # batch is written as a parquet file to .part directory and the parts are
+    # joined row group by row group when closed, so memory use stays bounded
+    # and an interrupted run can be continued as with csv.
+    formats = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+    
+    def __init__(self, filepath, stream=True, batch_size=10000):
+        super().__init__(filepath, stream=True, batch_size=batch_size)
+        self._pa, self._pq = _import_pyarrow()
+        self.format = self.formats.get(Path(filepath).suffix, 'parquet') if filepath is not None else 'parquet'
+        self._parts = 0
+        pa = self._pa
+        self.schema = pa.schema([('published', pa.date32()),
+                                 *((name, pa.string()) for name in ['abstract', 'language', 'publication', 
+                                                                    'publisher', 'title']),
+                                 ('key_words', pa.list_(pa.string())),
+                                 ('urls', pa.list_(pa.string())),
+                                 ('search_term', pa.string())])
+                                 
+    # Year or year and month of issue date are stored as the first day
+    @staticmethod
+    def _date(value):
+        if not value:
+            return None
+        value = value.strip()
+        try:
+            if re.fullmatch(r'\d{4}', value):
+                return date(int(value), 1, 1)
+            if re.fullmatch(r'\d{4}-\d{2}', value):
+                return date(int(value[:4]), int(value[5:7]), 1)
+            return date.fromisoformat(value[:10])
+        except ValueError:
+            logging.warning("Invalid date %s", value)
+            return None
+            
+    def _row(self, metadata):
+        row = {name: metadata.get(name) for name in self.fieldnames}
+        row['published'] = self._date(row['published'])
+        return row
+        
+    def open(self, append=False):
+        if self._filepath is None or self._file is not None:
+            return
+        if self.partpath.exists() and not append:
+            shutil.rmtree(self.partpath)
+        self.partpath.mkdir(exist_ok=True)
+        if append and Path(self._filepath).exists() and not any(self.partpath.iterdir()):
+            self._import(Path(self._filepath), self.partpath / f'{0:08d}.parquet')
+        logging.info("Writing to directory: %s", str(self.partpath))
+        self._file = self.partpath
+        self._parts = len(list(self.partpath.glob('*.parquet')))
+        
+    # Completed file of an earlier run as the first part
+    def _import(self, filepath, part):
+        if self.format == 'parquet':
+            os.replace(filepath, part)
+            return
+        reader = self._pa.ipc.open_file(filepath)
+        with self._pq.ParquetWriter(part, self.schema) as writer:
+            for i in range(reader.num_record_batches):
+                writer.write_batch(reader.get_batch(i))
+        filepath.unlink()
+        
+    def flush(self):
+        if self._filepath is None:
+            self._rows.clear()
+            return
+        if self._file is None:
+            self.open()
+        self._write_rows(self._file, self._rows)
+        self._rows.clear()
+        
+    def _write_rows(self, f, rows):
+        if not rows:
+            return
+        table = self._pa.Table.from_pylist([self._row(row) for row in rows], schema=self.schema)
+        part = f / f'{self._parts:08d}.parquet'
+        tmp = part.with_suffix('.tmp')
+        self._pq.write_table(table, tmp)
+        os.replace(tmp, part)
+        self._parts += 1
+        
+    def close(self):
+        if self._filepath is None:
+            return
+        self.flush()
+        tmp = Path(str(self._filepath) + '.tmp')
+        if self.format == 'parquet':
+            writer = self._pq.ParquetWriter(tmp, self.schema)
+        else:
+            writer = self._pa.ipc.new_file(tmp, self.schema)
+        with writer:
+            for part in sorted(self.partpath.glob('*.parquet')):
+                parquet = self._pq.ParquetFile(part)
+                for i in range(parquet.num_row_groups):
+                    writer.write_table(parquet.read_row_group(i))
+        if Path(self._filepath).exists():
+            logging.warning("Overwriting old file %s", self._filepath)
+        os.replace(tmp, self._filepath)
+        shutil.rmtree(self.partpath)
+        self._file = None
+        
+        
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet and Arrow output needs pyarrow, install with: pip install webscraper[parquet]")
+    return pyarrow, pyarrow.parquet
+    
+    
+# Csv writer or ParquetWriter by file extension
+def metadata_writer(filepath, **kwargs):
+    if filepath is not None and Path(filepath).suffix in ParquetWriter.formats:
+        return ParquetWriter(filepath, **kwargs)
+    return MetadataWriter(filepath, **kwargs)
+    
+    
+# Output file for a named search pattern: {name} in filepath is replaced with
+# pattern name, otherwise name is appended to the file stem.
+def output_path(filepath, name):
+    if filepath is None or name is None:
+        return filepath
+    if "{name}" in filepath:
+        return filepath.replace("{name}", name)
+    path = Path(filepath)
+    return str(path.with_name(f"{path.stem}_{name}{path.suffix}"))
+    
+
+class Job():
+    # Options of a job in a job file and their defaults, named as the long
+    # options of oai-harvest
+    options = {'name': None, 'url': None, 'sets': None, 'metadata_prefix': 'kk', 'workers': 2,
+               'shard': None, 'shard_size': 10000, 'state': None, 'seen': None, 'index': None,
+               'searchpatterns': None, 'patternfile': None, 'language': None, 'metadata': None,
+               'filelist': None, 'outdir': None, 'download': False, 'limit': None, 'parse_workers': 0,
+               'extract': None}
+    
+    # Harvest of one endpoint with its filters and outputs, as one run of
+    # oai-harvest. Records matching patterns are written to a metadata file and
+    # filelist per named pattern and their files submitted to downloader, all
+    # records are added to index (sqlite file, opened by the thread running the job).
+    # Text of downloaded files is extracted with extractor.
+    def __init__(self, records, record_filter, patterns, metadata=None, filelist=None, outdir=None,
+                 download=False, downloader=None, index=None, limit=None, name=None, extractor=None):
+        self.name = name or records.endpoint
+        self.records = records
+        self.record_filter = record_filter
+        self.patterns = patterns
+        self.metadata = metadata
+        self.filelist = filelist
+        self.outdir = outdir
+        self.download = download
+        self.downloader = downloader
+        self.index = index
+        self.limit = limit
+        self.extractor = extractor
+        self.metadatawriters = {name: metadata_writer(output_path(metadata, name), stream=True) 
+                                for name in patterns.names}
+        self.filelistwriters = {name: FilelistWriter(output_path(filelist, name)) for name in patterns.names}
+        
+    # Job of a job file, harvested through scheduler. ValueError for invalid options.
+    @classmethod
+    def from_config(cls, config, scheduler=None, downloader=None, cache=None, offline=False, sets_ttl=24,
+                    metrics=None, extractors=None):
+        unknown = set(config) - set(cls.options)
+        if unknown:
+            raise ValueError(f"Unknown job options: {', '.join(sorted(unknown))}")
+        config = {**cls.options, **config}
+        if not config['url']:
+            raise ValueError("Job needs an url")
+        if config['download'] and not config['outdir']:
+            raise ValueError(f"Job {config['url']} downloads but has no outdir")
+        if config['extract'] and not config['download']:
+            raise ValueError(f"Job {config['url']} extracts text but does not download")
+        if config['shard'] is not None and config['shard'] not in Records.shard_modes:
+            raise ValueError(f"Invalid shard {config['shard']}")
+        # Record parses only kk metadata
+        if config['metadata_prefix'] != Records.metadata:
+            raise ValueError(f"Unsupported metadata_prefix {config['metadata_prefix']}, only {Records.metadata} is parsed")
+        patterns = config['searchpatterns']
+        patterns = SearchPatterns.from_args([patterns] if isinstance(patterns, str) else patterns, 
+                                            config['patternfile'])
+        sets = config['sets']
+        sets = [sets] if isinstance(sets, str) else sets
+        sets_lookup = None
+        if sets:
+            registry = SetRegistry(config['url'], ttl=sets_ttl, offline=offline)
+            registry.resolve(sets)
+            sets_lookup = registry.lookup
+        record_filter = RecordFilter(config['language'], patterns, metrics=metrics)
+        records = Records(config['url'], sets, workers=config['workers'], shard=config['shard'], 
+                          shard_size=config['shard_size'], 
+                          state=HarvestState(config['state']) if config['state'] else None, 
+                          cache=cache, offline=offline, seen=SeenSet(config['seen']) if config['seen'] else None,
+                          metrics=metrics, parse_workers=config['parse_workers'], record_filter=record_filter,
+                          keep_metadata=bool(config['index']), sets_lookup=sets_lookup, 
+                          metadata_prefix=config['metadata_prefix'],
+                          session=scheduler.session if scheduler is not None else None, scheduler=scheduler)
+        return cls(records, record_filter, patterns, metadata=config['metadata'], filelist=config['filelist'],
+                   outdir=config['outdir'], download=config['download'], downloader=downloader,
+                   index=config['index'], limit=config['limit'], name=config['name'],
+                   extractor=(extractors or {}).get(config['extract']))
+        
+    def run(self):
+        records = self.records
+        record_filter = self.record_filter
+        patterns = self.patterns
+        metadatawriters = self.metadatawriters
+        filelistwriters = self.filelistwriters
+        writers = [*metadatawriters.values(), *filelistwriters.values()]
+        index = MetadataIndex(self.index) if self.index else None
+        
+        # Continue output files of an interrupted run
+        for writer in writers:
+            writer.open(append=records.resuming)
+        
+        logging.debug("Start looping over records of %s", self.name)
+        
+        for record in records:
+            
+            if records.state is not None and records.idx % HarvestState.interval == 0:
+                for writer in writers:
+                    writer.flush()
+                if index is not None:
+                    index.flush()
+                if self.download:
+                    self.downloader.flush()
+                records.checkpoint()
+            
+            if self.limit is not None and records.idx > self.limit:
+                break
+                
+            if index is not None:
+                with records.metrics.timer('index_seconds'):
+                    index.add(record)
+            
+            if not record_filter(record):
+                continue  # Skip record and continue to next loop
+
+            #if not OUTDIR:
+            #    pass
+            #else:
+            #    for i in record.metadata["urls"]:
+            #        downloader.url = i
             
+            for name in record.matches:
+                if self.download:
+                    callback = None
+                    if self.extractor is not None:
+                        callback = partial(self.extractor.submit, identifier=record.identifier, 
+                                           metadata=record.metadata)
+                    for i in record.metadata["urls"]:
+                        self.downloader.submit(i, output_path(self.outdir, name), callback)
+                        
+                with records.metrics.timer('write_seconds'):
+                    if not self.metadata:
+                        pass
+                    else:
+                        metadatawriters[name].metadata = {**record.metadata, "search_term": patterns[name]}
+                        
+                    if not self.filelist:
+                        pass
+                    else:
+                        for i in record.metadata["urls"]:
+                            filelistwriters[name].url = i
+                            
+            records.exported(record)
         
+        records.close()
+        
+        for writer in writers:
+            writer.close()
+        if index is not None:
+            index.close()
+        records.checkpoint()
+        
+        
+# Job file options and their defaults, defaults table has job options
+# shared by all jobs
+JOBFILE_OPTIONS = {'workers': 8, 'concurrency': 4, 'rate': None, 'store': None, 'cache': None, 
+                   'cache_size': 1024, 'offline': False, 'sets_ttl': 24, 'extract_workers': None, 'resync': False,
+                   'defaults': {}, 'jobs': []}
+
+
+# Settings and jobs of a TOML or JSON job file
+def read_jobfile(filepath):
+    path = Path(filepath)
+    if path.suffix == '.toml':
+        import tomllib
+        with open(path, 'rb') as f:
+            config = tomllib.load(f)
+    else:
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+    unknown = set(config) - set(JOBFILE_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown options: {', '.join(sorted(unknown))}")
+    config = {**JOBFILE_OPTIONS, **config}
+    jobs = [{**config['defaults'], **job} for job in config['jobs']]
+    if not jobs:
+        raise ValueError("No jobs")
+    names = [job.get('name') or urlparse(job.get('url', '')).netloc for job in jobs]
+    for job, name in zip(jobs, names):
+        job['name'] = name
+    if len(set(names)) < len(names):
+        raise ValueError("Jobs need unique names")
+    return config, jobs
     
+
 def cli_args():
     parser = argparse.ArgumentParser(description=__doc__)
 
@@ -350,10 +2890,68 @@ def cli_args():
                         type=int, default=None)
 
     parser.add_argument("-p", "--publishers", 
-                        choices=list(KansallisarkistoOAI.sets_lookup.keys()), metavar="'Ympäristöministeriö|Valtioneuvosto|...'",
-                        help="""Limit search for certain publishers. Defaults to all. Use -lp to list publishers.""",
+                        metavar="'Ympäristöministeriö|Valtioneuvosto|...'",
+                        help="""Limit search for certain publishers (names or setSpecs). Defaults to all. Use -lp to list publishers.""",
                         type=str, nargs='*', default=None)
                         
+    parser.add_argument("-w", "--workers",
+                        metavar="<integer>",
+                        help=("Number of publisher sets harvested concurrently, default 1 (requests in flight "
+                              "with --engine async, default 100)"),
+                        type=int, default=None)
+                        
+    parser.add_argument("-pw", "--parse-workers",
+                        metavar="<integer>",
+                        help="Parse and filter pages in this many processes, eg. when replaying a cache",
+                        type=int, default=0)
+                        
+    parser.add_argument("-e", "--engine",
+                        choices=['sickle', 'async'], default='sickle',
+                        help="Harvest with Sickle in threads or with asyncio (needs aiohttp)")
+                        
+    parser.add_argument("-s", "--shard",
+                        choices=Records.shard_modes,
+                        help=("Split harvest to date windows harvested in parallel (with --workers). "
+                              "Windows larger than --shard-size are split automatically"),
+                        type=str, default=None)
+    
+    parser.add_argument("--shard-size",
+                        metavar="<integer>",
+                        help="Max number of records in a date window",
+                        type=int, default=10000)
+                        
+    parser.add_argument("-st", "--state",
+                        type=str, metavar="<filepath>",
+                        help=("Incremental harvest: fetch only records added or changed since the "
+                              "previous run using this state file. Interrupted run continues from "
+                              "its last checkpoint"))
+                        
+    parser.add_argument("--seen",
+                        type=str, metavar="<filepath>",
+                        help="skip records harvested on earlier runs, identifiers are kept in the file")
+                        
+    parser.add_argument("--metrics",
+                        type=str, metavar="<filepath>",
+                        help=("print timing and counters of the run and write them to a file, "
+                              "JSON or Prometheus textfile with .prom extension"))
+                        
+    parser.add_argument("-i", "--index",
+                        type=str, metavar="<filepath>",
+                        help="store metadata of all harvested records to an sqlite database, search it with oai-index")
+                        
+    parser.add_argument("-c", "--cache",
+                        type=str, metavar="<directory>",
+                        help="Store raw responses of the service to a local cache")
+                        
+    parser.add_argument("--cache-size",
+                        metavar="<megabytes>",
+                        help="Max size of the cache, least recently used responses are removed",
+                        type=int, default=1024)
+                        
+    parser.add_argument("--offline",
+                        help="Replay the harvest from the cache (-c) without connecting the service",
+                        action="store_true")
+                        
     parser.add_argument("-l", "--language", 
                         choices=['fi', 'sv', 'en'],
                         help="Limit to specific language",
@@ -362,18 +2960,64 @@ def cli_args():
     parser.add_argument("-lp", "--listpublishers",
                         help="List available sets/publishers",
                         action="store_true")
+                        
+    parser.add_argument("--sets-ttl",
+                        metavar="<hours>",
+                        help="Hours publisher sets from ListSets are cached, 0 to refresh",
+                        type=float, default=24)
     
     parser.add_argument("-sp", "--searchpattern",
-                        help="Filter documents by regex",
-                        type=str, default=None)
+                        metavar="[<name>=]<regex>",
+                        help=("Filter documents by regex. Repeat with named patterns (-sp name=regex) "
+                              "to search all of them in one harvest, use {name} in -m/-f paths "
+                              "to name output files per pattern. Write = of an unnamed regex "
+                              "as [=] when it follows a word (x[=]y)"),
+                        type=str, action="append", default=None)
+    
+    parser.add_argument("-spf", "--patternfile",
+                        type=str, metavar="<filepath>",
+                        help="read named search patterns from a file, one name=regex per line")
                         
     parser.add_argument("-o", "--outdir",
                         type=str, metavar="<directory>",
-                        help="download files to a directory (NOTE! use list urls instead and then download with eg. wget)")
+                        help="directory for downloaded files with --download, use {name} for a directory per search pattern")
+                        
+    parser.add_argument("-d", "--download",
+                        action="store_true",
+                        help="download files of matching records to outdir while harvesting")
+                        
+    parser.add_argument("-cc", "--concurrency",
+                        metavar="<integer>",
+                        help="Number of concurrent downloads with --download",
+                        type=int, default=4)
+                        
+    parser.add_argument("-r", "--rate",
+                        metavar="<number>",
+                        help="Max download requests per second to a single host",
+                        type=float, default=None)
                         
+    parser.add_argument("--store",
+                        type=str, metavar="<directory>",
+                        help="Keep downloaded files once in a shared store and hard link them to outdir")
+
+    parser.add_argument("--resync",
+                        help=("Revalidate files downloaded earlier with conditional requests and download again "
+                              "the ones which have changed"),
+                        action="store_true")
+
+    parser.add_argument("-x", "--extract",
+                        type=str, metavar="<directory|filepath.jsonl>",
+                        help=("Extract text of downloaded files to .txt files in a directory or to a JSONL file "
+                              "with record identifier and metadata, unchanged files are skipped on later runs"))
+
+    parser.add_argument("--extract-workers",
+                        metavar="<integer>",
+                        help="Number of text extraction processes, defaults to number of cores",
+                        type=int, default=None)
+
     parser.add_argument("-m", "--metadata",
                         type=str, metavar="<filepath>",
-                        help="save metadata to a file")
+                        help="save metadata to a csv file, or Parquet/Arrow file with .parquet/.arrow extension")
                  
     parser.add_argument("-f", "--filelist",
                         type=str, metavar="<filepath>",
@@ -402,10 +3046,20 @@ def main():
     LISTPUBLISHERS = args.listpublishers
     URL = args.URL
     PUBLISHERS = args.publishers
+    WORKERS = args.workers
+    ENGINE = args.engine
+    SHARD = args.shard
+    SHARD_SIZE = args.shard_size
+    STATE = args.state
+    CACHE = args.cache
+    CACHE_SIZE = args.cache_size
+    OFFLINE = args.offline
     LIMIT = args.limit
     SEARCHPATTERN = args.searchpattern
+    PATTERNFILE = args.patternfile
     LANGUAGE = args.language
     OUTDIR = args.outdir
+    DOWNLOAD = args.download
     FILEPATH = args.metadata
     FILELIST = args.filelist
     VERBOSE = args.verbose
@@ -426,60 +3080,420 @@ def main():
         datefmt='%d-%b-%y %H:%M:%S'
         )
     
+    if LISTPUBLISHERS or PUBLISHERS:
+        registry = SetRegistry(URL, ttl=args.sets_ttl, offline=OFFLINE)
+        
     if LISTPUBLISHERS:
-        pprint.pp(list(SETS.keys()))
+        pprint.pp(list(registry.lookup.keys()))
         exit()
+        
+    if PUBLISHERS:
+        try:
+            registry.resolve(PUBLISHERS)
+        except ValueError as ex:
+            raise SystemExit(f"{ex}. Use -lp to list publishers.")
 
-    records = Records(URL, PUBLISHERS)
+    try:
+        patterns = SearchPatterns.from_args(SEARCHPATTERN, PATTERNFILE)
+    except (ValueError, re.error) as ex:
+        raise SystemExit(f"Invalid search patterns: {ex}")
+    
+    if OFFLINE and not CACHE:
+        raise SystemExit("--offline needs the cache directory (-c)")
+        
+    if DOWNLOAD and not OUTDIR:
+        raise SystemExit("--download needs the output directory (-o)")
+        
+    if args.extract and not DOWNLOAD:
+        raise SystemExit("--extract needs --download")
+    
+    state = HarvestState(STATE) if STATE else None
+    
+    cache = ResponseCache(CACHE, CACHE_SIZE * 1024**2) if CACHE else None
+    
+    engine = AsyncRecords if ENGINE == 'async' else Records
+    
+    metrics = Metrics() if args.metrics else None
+    
+    record_filter = RecordFilter(LANGUAGE, patterns, metrics=metrics)
     
-    downloader = Downloader(OUTDIR)
+    # Engines have their own default concurrency
+    workers = {'workers': WORKERS} if WORKERS is not None else {}
     
-    metadatawriter = MetadataWriter(FILEPATH)
+    try:
+        records = engine(URL, PUBLISHERS, **workers, shard=SHARD, shard_size=SHARD_SIZE, state=state,
+                         cache=cache, offline=OFFLINE, seen=SeenSet(args.seen) if args.seen else None,
+                         metrics=metrics, parse_workers=args.parse_workers, record_filter=record_filter,
+                         keep_metadata=bool(args.index),
+                         sets_lookup=registry.lookup if PUBLISHERS else None)
+    except ImportError as ex:
+        raise SystemExit(str(ex))
+    except CacheMiss as ex:
+        raise SystemExit(f"{ex}. Offline harvest needs the options of the recorded harvest.")
     
-    logging.debug("Start looping over records")
+    downloader = Downloader(OUTDIR, concurrency=args.concurrency, rate=args.rate, store=args.store, metrics=metrics,
+                            resync=args.resync)
     
-    for record in records:
+    # One metadata file and filelist per search pattern, written while harvesting
+    try:
+        extractor = TextExtractor(args.extract, workers=args.extract_workers, metrics=metrics) if args.extract else None
+        job = Job(records, record_filter, patterns, metadata=FILEPATH, filelist=FILELIST, outdir=OUTDIR,
+                  download=DOWNLOAD, downloader=downloader, index=args.index, limit=LIMIT, extractor=extractor)
+    except ImportError as ex:
+        raise SystemExit(str(ex))
+    
+    # Files are downloaded while the harvest continues and their text
+    # extracted as soon as they are ready
+    if extractor is not None:
+        extractor.start()
+    if DOWNLOAD:
+        downloader.start()
+    
+    try:
+        job.run()
+    except CacheMiss as ex:
+        records.close()
+        raise SystemExit(f"{ex}. Offline harvest needs the options of the recorded harvest.")
+    #downloader.threaded_download()
+    downloader.join()
+    if extractor is not None:
+        extractor.join()
         
-        if record.counter == LIMIT:
-            break
         
-        if not record.filter(LANGUAGE, SEARCHPATTERN):
-            continue  # Skip record and continue to next loop
+    logging.info("Finished queries. Total of %s records, found %s matching records and downloaded %s files", 
+                 records.idx, record_filter.matched, downloader._download_success)
+    if metrics is not None:
+        print(metrics.summary())
+        metrics.write(args.metrics)
+    #if downloader._download_success < downloader._download_attempt:
+    #    logging.warning('Download of %s files failed', 
+    #                    downloader._download_attempt-downloader._download_success)
 
-        #if not OUTDIR:
-        #    pass
-        #else:
-        #    for i in record.metadata["urls"]:
-        #        downloader.url = i
+
+def download_args():
+    parser = argparse.ArgumentParser(description="Download files listed in filelists written by oai-harvest -f")
+    
+    parser.add_argument("filelist",
+                        metavar="<filepath>",
+                        help="file with one url per line, with --resync defaults to all files of the manifest",
+                        type=str, nargs='*')
+                        
+    parser.add_argument("-o", "--outdir",
+                        type=str, metavar="<directory>",
+                        help="download files to a directory, defaults to current directory")
+                        
+    parser.add_argument("-cc", "--concurrency",
+                        metavar="<integer>",
+                        help="Number of concurrent downloads",
+                        type=int, default=4)
+                        
+    parser.add_argument("-r", "--rate",
+                        metavar="<number>",
+                        help="Max requests per second to a single host",
+                        type=float, default=None)
+                        
+    parser.add_argument("--retries",
+                        metavar="<integer>",
+                        help="Number of retries of a failed download",
+                        type=int, default=3)
+                        
+    parser.add_argument("-s", "--store",
+                        type=str, metavar="<directory>",
+                        help=("Keep each file once in a shared store and hard link it to outdir, "
+                              "files already in the store are not downloaded again"))
+                              
+    parser.add_argument("--resync",
+                        help=("Revalidate downloaded files with conditional requests and download again "
+                              "the ones which have changed"),
+                        action="store_true")
+                        
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Verbosity of logging (-v, -vv, etc)")
         
-        if not FILEPATH:
-            pass
-        else:
-            metadatawriter.metadata = record.metadata
-            
-        if not FILELIST:
-            pass
+    return parser.parse_args()
+    
+    
+def download_main():
+    """ Download files of filelists """
+    args = download_args()
+    
+    logging.basicConfig(
+        format='[%(asctime)s] - [%(levelname)s] - %(message)s', 
+        level=[logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 3)], 
+        datefmt='%d-%b-%y %H:%M:%S'
+        )
+        
+    downloader = Downloader(args.outdir, concurrency=args.concurrency, rate=args.rate, retries=args.retries,
+                            store=args.store, resync=args.resync)
+    if not args.filelist:
+        if not args.resync:
+            raise SystemExit("Give a filelist or --resync")
+        downloader._urls = downloader.manifest_urls()
+        logging.info("Revalidating %s files", len(downloader._urls))
+    for filelist in args.filelist:
+        with open(filelist, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    downloader.url = line.strip()
+                    
+    downloader.threaded_download()
+    if args.resync:
+        logging.info('%s files have not changed', downloader._download_unchanged)
+    if downloader._download_success + downloader._download_unchanged < downloader._download_attempt:
+        logging.warning('Download of %s files failed or skipped',
+                        downloader._download_attempt - downloader._download_success - downloader._download_unchanged)
+
+
+def extract_args():
+    parser = argparse.ArgumentParser(description="Extract text of downloaded pdf files, eg. of oai-download")
+
+    parser.add_argument("files",
+                        metavar="<filepath|directory>",
+                        help="pdf files or directories searched for them",
+                        type=str, nargs='+')
+
+    parser.add_argument("-o", "--output",
+                        type=str, metavar="<directory|filepath.jsonl>", required=True,
+                        help="directory of .txt files or a JSONL file, unchanged files are skipped on later runs")
+
+    parser.add_argument("-w", "--workers",
+                        metavar="<integer>",
+                        help="Number of extraction processes, defaults to number of cores",
+                        type=int, default=None)
+
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Verbosity of logging (-v, -vv, etc)")
+
+    return parser.parse_args()
+
+
+def extract_main():
+    """ Extract text of pdf files in parallel """
+    args = extract_args()
+
+    logging.basicConfig(
+        format='[%(asctime)s] - [%(levelname)s] - %(message)s',
+        level=[logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 3)],
+        datefmt='%d-%b-%y %H:%M:%S'
+        )
+
+    try:
+        extractor = TextExtractor(args.output, workers=args.workers)
+    except ImportError as ex:
+        raise SystemExit(str(ex))
+
+    extractor.start()
+    for filepath in map(Path, args.files):
+        if filepath.is_dir():
+            for path in sorted(filepath.rglob('*')):
+                if path.suffix.lower() == '.pdf' and path.is_file():
+                    extractor.submit(path)
         else:
-            for i in record.metadata["urls"]:
-                downloader.url = i
-            
+            extractor.submit(filepath)
+    extractor.join()
+    if extractor.failed:
+        logging.warning('Text extraction of %s files failed', extractor.failed)
+
+
+def index_args():
+    parser = argparse.ArgumentParser(description="Search metadata index written by oai-harvest -i")
+    
+    parser.add_argument("index",
+                        metavar="<filepath>",
+                        help="sqlite metadata index",
+                        type=str)
+                        
+    parser.add_argument("-l", "--language",
+                        type=str, metavar="<language>",
+                        help="Filter documents by language, eg. fi, sv, en")
+                        
+    parser.add_argument("-sp", "--searchpattern",
+                        metavar="[<name>=]<regex>",
+                        help="Filter documents by regex as in oai-harvest, repeat with named patterns",
+                        type=str, action="append", default=None)
+    
+    parser.add_argument("-spf", "--patternfile",
+                        type=str, metavar="<filepath>",
+                        help="read named search patterns from a file, one name=regex per line")
+                        
+    parser.add_argument("-fts", "--match",
+                        type=str, metavar="<query>",
+                        help="FTS5 full-text query run before search patterns, eg. 'maaseu*'")
+                        
+    parser.add_argument("-m", "--metadata",
+                        type=str, metavar="<filepath>",
+                        help="save metadata to a csv file, or Parquet/Arrow file with .parquet/.arrow extension")
+                 
+    parser.add_argument("-f", "--filelist",
+                        type=str, metavar="<filepath>",
+                        help="save list of file urls to a file")
+                        
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Verbosity of logging (-v, -vv, etc)")
         
-    if not downloader.url:
-        logging.debug("No filelist written")
-    else:
-        logging.info("Writing filelist to file: %s", str(FILELIST))
-        with open(FILELIST, 'w', encoding='utf-8') as outfile:
-            outfile.writelines((str(i)+'\n' for i in downloader.url))
-        #downloader.threaded_download()
+    return parser.parse_args()
+    
+    
+def index_main():
+    """ Search metadata index with new patterns without harvesting again """
+    args = index_args()
+    
+    logging.basicConfig(
+        format='[%(asctime)s] - [%(levelname)s] - %(message)s', 
+        level=[logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 3)], 
+        datefmt='%d-%b-%y %H:%M:%S'
+        )
+        
+    try:
+        patterns = SearchPatterns.from_args(args.searchpattern, args.patternfile)
+    except (ValueError, re.error) as ex:
+        raise SystemExit(f"Invalid search patterns: {ex}")
+        
+    if not Path(args.index).exists():
+        raise SystemExit(f"No index {args.index}")
+    index = MetadataIndex(args.index)
+    record_filter = RecordFilter(args.language, patterns)
+    
+    try:
+        metadatawriters = {name: metadata_writer(output_path(args.metadata, name), stream=True) 
+                           for name in patterns.names}
+    except ImportError as ex:
+        raise SystemExit(str(ex))
+    filelistwriters = {name: FilelistWriter(output_path(args.filelist, name)) for name in patterns.names}
+    writers = [*metadatawriters.values(), *filelistwriters.values()]
+    for writer in writers:
+        writer.open()
+        
+    matches = 0
+    try:
+        for record in index.records(args.language, args.match):
+            if not record_filter(record):
+                continue
+            matches += 1
+            for name in record.matches:
+                if args.metadata:
+                    metadatawriters[name].metadata = {**record.metadata, "search_term": patterns[name]}
+                if args.filelist:
+                    for i in record.metadata["urls"]:
+                        filelistwriters[name].url = i
+    except sqlite3.OperationalError as ex:
+        raise SystemExit(f"Invalid query: {ex}")
+    finally:
+        for writer in writers:
+            writer.close()
+        index.close()
+    logging.info("Found %s matching records", matches)
+
+
+def jobs_args():
+    parser = argparse.ArgumentParser(description=("Harvest several OAI-PMH services listed in a job file "
+                                                  "(TOML or JSON) in one process"))
+    
+    parser.add_argument("jobfile",
+                        metavar="<filepath>",
+                        help="job file, see README for the options",
+                        type=str)
+                        
+    parser.add_argument("-w", "--workers",
+                        metavar="<integer>",
+                        help="Number of worker threads shared by all jobs, overrides workers of the job file",
+                        type=int, default=None)
+                        
+    parser.add_argument("--metrics",
+                        type=str, metavar="<filepath>",
+                        help=("print timing and counters of all jobs and write them to a file, "
+                              "JSON or Prometheus textfile with .prom extension"))
+                        
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Verbosity (-v, -vv, etc)")
+        
+    return parser.parse_args()
+    
+    
+def _run_job(job, failed):
+    try:
+        job.run()
+        logging.info("Finished job %s. Total of %s records, found %s matching records", 
+                     job.name, job.records.idx, job.record_filter.matched)
+    except Exception as ex:
+        logging.error(f'Job {job.name} failed: {ex}')
+        job.records.close()
+        failed.append(job.name)
+        
+        
+def jobs_main():
+    """ Harvest all jobs of a job file sharing one pool of workers """
+    args = jobs_args()
+    
+    logging.basicConfig(
+        format='[%(asctime)s] - [%(levelname)s] - %(message)s', 
+        level=[logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 3)], 
+        datefmt='%d-%b-%y %H:%M:%S'
+        )
         
+    try:
+        config, jobs = read_jobfile(args.jobfile)
+    except (OSError, ValueError) as ex:
+        raise SystemExit(f"Invalid job file {args.jobfile}: {ex}")
         
-    if metadatawriter.metadata is not None:
-        metadatawriter.write_csv()
+    if config['offline'] and not config['cache']:
+        raise SystemExit("offline needs the cache directory")
         
+    cache = ResponseCache(config['cache'], config['cache_size'] * 1024**2) if config['cache'] else None
+    metrics = Metrics() if args.metrics else None
+    scheduler = Scheduler(args.workers or config['workers'])
+    downloader = Downloader(None, concurrency=config['concurrency'], rate=config['rate'], store=config['store'],
+                            metrics=metrics, resync=config['resync'])
+    
+    try:
+        # Jobs with the same extract output share its extractor
+        extractors = {job['extract']: TextExtractor(job['extract'], workers=config['extract_workers'], 
+                                                    metrics=metrics)
+                      for job in jobs if job.get('extract')}
+        jobs = [Job.from_config(job, scheduler=scheduler, downloader=downloader, cache=cache, 
+                                offline=config['offline'], sets_ttl=config['sets_ttl'], metrics=metrics,
+                                extractors=extractors) 
+                for job in jobs]
+    except (ValueError, re.error, ImportError) as ex:
+        raise SystemExit(f"Invalid job: {ex}")
         
-    logging.info("Finished queries. Total of %s queries, found %s matching records and downloaded %s files", 
-                 record.counter, Record._matches, downloader._download_success)
-    #if downloader._download_success < downloader._download_attempt:
-    #    logging.warning('Download of %s files failed', 
-    #                    downloader._download_attempt-downloader._download_success)
-                       
+    for extractor in extractors.values():
+        extractor.start()
+    scheduler.start()
+    if any(job.download for job in jobs):
+        downloader.start()
+        
+    # Each job writes its outputs in its own thread, requests are made by the scheduler
+    failed = []
+    threads = [threading.Thread(target=_run_job, args=(job, failed), name=job.name) for job in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    scheduler.close()
+    downloader.join()
+    for extractor in extractors.values():
+        extractor.join()
+    
+    logging.info("Finished %s jobs, downloaded %s files", len(jobs), downloader._download_success)
+    if metrics is not None:
+        print(metrics.summary())
+        metrics.write(args.metrics)
+    if failed:
+        raise SystemExit(f"Failed jobs: {', '.join(failed)}")